@@ -9,79 +9,236 @@ Proceedings of the 54th Annual Meeting of the Association for Computational Ling
 
 # python3 only
 
+import os
 import sys
 import argparse
 import re
+import heapq
+import pickle
+import mmap
+import hashlib
+import zlib
+import multiprocessing
+from array import array
+from itertools import islice, accumulate
+from collections import OrderedDict, deque
 
 
-class BPE(object):
+class SegmentCache(object):
+    """Size-bounded cache of encoded words with least-recently-used eviction
 
-    def __init__(self, codes, merges=-1, separator='@@', vocab=None, glossaries=None):
+    max_size of None means unbounded. hits and misses count lookups with get().
+    """
 
-        codes.seek(0)
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, word):
+        return word in self.entries
+
+    def get(self, word, default=None):
+        try:
+            value = self.entries[word]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(word)
+        return value
+
+    def __setitem__(self, word, value):
+        self.entries[word] = value
+        self.entries.move_to_end(word)
+        # evict least recently used
+        if self.max_size is not None:
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def save(self, path, key):
+        """Write entries to path, tagged with key (see BPE.cache_key)"""
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'key': key, 'entries': list(self.entries.items())}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self, path, key):
+        """Preload entries from path, return False if it was written with another key"""
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if data.get('key') != key:
+            return False
+        for word, value in data['entries']:
+            self[word] = value
+        return True
 
-        # check version information
-        firstline = codes.readline()
-        if firstline.startswith('# version'):
-            self.version = firstline.strip().split()[-1]
-        else:
-            self.version = 'unknown'
-            codes.seek(0)
 
-        # limited by number of merge
-        self.bpe_codes = [tuple(item.split()) for (n, item) in enumerate(codes) if (n < merges or merges == -1)]
+class BPE(object):
 
-        # some hacking to deal with duplicates (only consider first instance)
-        self.bpe_codes = dict([(code,i) for (i,code) in reversed(list(enumerate(self.bpe_codes)))])
-        
-        self.bpe_codes_reverse = dict([(pair[0] + pair[1], pair) for pair,i in self.bpe_codes.items()])
+    def __init__(self, codes, merges=-1, separator='@@', vocab=None, glossaries=None, cache_size=None, engine='heap',
+                 glossary_patterns=None, glossary_longest_match=False):
+
+        compiled = load_compiled_codes(codes)
+        oov_splits = None
+
+        if compiled is None:
+            self.version, pairs = read_codes(codes, merges)
+            self.bpe_codes, self.bpe_codes_reverse = build_codes(pairs)
+        else:
+            self.version = compiled['version']
+            if merges == -1 or merges >= compiled['num_pairs']:
+                # tables are looked up in the file
+                self.bpe_codes = compiled['bpe_codes']
+                self.bpe_codes_reverse = compiled['bpe_codes_reverse']
+                if vocab is None and compiled['separator'] == separator:
+                    oov_splits = compiled['oov_splits']
+            else:
+                self.bpe_codes, self.bpe_codes_reverse = build_codes(compiled['pairs']()[:merges])
+            if vocab is None:
+                vocab = compiled['vocab']
 
         self.separator = separator
 
         # avoid oov
         self.vocab = vocab
 
+        # split of each merged symbol that is oov, so filtering is a lookup per subword
+        if oov_splits is None and vocab:
+            oov_splits = build_oov_splits(self.bpe_codes_reverse, vocab, separator)
+        self.oov_splits = oov_splits
+
         # protected subword
         self.glossaries = glossaries if glossaries else []
 
-        self.cache = {}
+        # protected regular expressions
+        self.glossary_patterns = glossary_patterns if glossary_patterns else []
+
+        # isolate overlapping glossaries by leftmost longest match, instead of in the order of glossaries
+        self.glossary_longest_match = glossary_longest_match
+
+        # all glossaries compiled into a single matcher
+        self.glossary_matcher = GlossaryMatcher(self.glossaries, self.glossary_patterns, glossary_longest_match)
+
+        # encoded words, least recently used are evicted beyond cache_size
+        self.cache = SegmentCache(cache_size)
+
+        # algorithm applying merge operations, same segmentation for all
+        self.merge = MERGE_ENGINES[engine]
+
+    def cache_key(self):
+        """Hash of everything that affects the segmentation of a word
+
+        a saved cache is only valid for a BPE with the same key
+        """
+        h = hashlib.sha1()
+        h.update('version {0}\nseparator {1}\n'.format(self.version, self.separator).encode('UTF-8'))
+        for pair, _ in sorted(self.bpe_codes.items(), key=lambda x: x[1]):
+            h.update('{0} {1}\n'.format(*pair).encode('UTF-8'))
+        h.update(b'\0vocab\n')
+        for word in sorted(self.vocab) if self.vocab else []:
+            h.update(word.encode('UTF-8') + b'\n')
+        h.update(b'\0glossaries\n')
+        for gloss in self.glossaries:
+            h.update(gloss.encode('UTF-8') + b'\n')
+        h.update(b'\0glossary patterns\n')
+        for pattern in self.glossary_patterns:
+            h.update(pattern.encode('UTF-8') + b'\n')
+        if self.glossary_longest_match:
+            h.update(b'\0glossary longest match\n')
+        return h.hexdigest()
+
+    def load_cache(self, path):
+        """Preload cache saved by save_cache, return False if it is stale"""
+        return self.cache.load(path, self.cache_key())
+
+    def save_cache(self, path):
+        self.cache.save(path, self.cache_key())
 
     def segment(self, sentence):
         """segment single sentence (whitespace-tokenized string) with BPE encoding"""
+        # tokenized by space
+        return ' '.join(self.segment_tokens(sentence.split(' ')))
+
+    def segment_tokens(self, tokens):
+        """segment list of words with BPE encoding, return list of subwords (with separator except last subword of a word)"""
         output = []
+        segment_word = self._segment_word
 
-        # tokenized by space
-        for word in sentence.split(' '):
+        for word in tokens:
             # eliminate double spaces
             if not word:
                 continue
-            new_word = [out for segment in self._isolate_glossaries(word)
-                        for out in encode(segment,
-                                          self.bpe_codes,
-                                          self.bpe_codes_reverse,
-                                          self.vocab,
-                                          self.separator,
-                                          self.version,
-                                          self.cache,
-                                          self.glossaries)]
-
-            # add separator except last subword
-            for item in new_word[:-1]:
-                output.append(item + self.separator)
-            output.append(new_word[-1])
-
-        return ' '.join(output)
+            output.extend(segment_word(word))
+
+        return output
+
+    def segment_batch(self, sentences):
+        """segment list of sentences (whitespace-tokenized strings or lists of words), return list of lists of subwords
+
+        each distinct word of the batch is segmented once
+        """
+        batch = [sentence.split(' ') if isinstance(sentence, str) else sentence for sentence in sentences]
+
+        # subwords of each distinct word
+        segmented = {}
+        for tokens in batch:
+            for word in tokens:
+                if word and word not in segmented:
+                    segmented[word] = self._segment_word(word)
+
+        return [[item for word in tokens if word for item in segmented[word]] for tokens in batch]
+
+    def segment_iter(self, sentences, batch_size=1000):
+        """lazily segment an iterable of sentences (see segment_batch), yield list of subwords per sentence"""
+        sentences = iter(sentences)
+        for batch in iter(lambda: list(islice(sentences, batch_size)), []):
+            for tokens in self.segment_batch(batch):
+                yield tokens
+
+    def _segment_word(self, word):
+        """segment single word, return list of subwords"""
+        new_word = [out for segment in self._isolate_glossaries(word)
+                    for out in encode(segment,
+                                      self.bpe_codes,
+                                      self.bpe_codes_reverse,
+                                      self.vocab,
+                                      self.separator,
+                                      self.version,
+                                      self.cache,
+                                      self.glossary_matcher,
+                                      self.merge,
+                                      self.oov_splits)]
+
+        # add separator except last subword
+        output = [item + self.separator for item in new_word[:-1]]
+        output.append(new_word[-1])
+        return output
+
+    def segment_line(self, line):
+        """segment raw input line, keeping its leading and trailing whitespace"""
+        out = []
 
-    def _isolate_glossaries(self, word):
-        word_segments = [word]
+        # keep leading whitespace
+        leading_whitespace = len(line)-len(line.lstrip())
+        if leading_whitespace:
+            out.append(line[:leading_whitespace])
 
-        # depend on order of glossary
-        for gloss in self.glossaries:
+        out.append(self.segment(line.strip()))
 
-            # split word by glossaries
-            word_segments = [out_segments for segment in word_segments
-                                 for out_segments in isolate_glossary(segment, gloss)]
-        return word_segments
+        # keep trailing whitespace
+        trailing_whitespace = len(line)-len(line.rstrip())
+        if trailing_whitespace:
+            out.append(line[-trailing_whitespace:])
+
+        return ''.join(out)
+
+    def _isolate_glossaries(self, word):
+        return self.glossary_matcher.isolate(word)
 
 
 def create_parser():
@@ -98,7 +255,7 @@ def create_parser():
     parser.add_argument(
         '--codes', '-c', type=argparse.FileType('r', encoding='UTF-8'), 
         metavar='PATH', required=True,
-        help="File with BPE codes (created by learn_bpe.py)")
+        help="File with BPE codes (created by learn_bpe.py or compile_bpe.py)")
 
     parser.add_argument(
         '--merges', '-m', type=int, default=-1,
@@ -131,9 +288,399 @@ def create_parser():
         help="Glossaries. The strings provided in glossaries will not be affected"+
              "by the BPE (i.e. they will neither be broken into subwords, nor concatenated with other subwords")
 
+    parser.add_argument(
+        '--glossary-patterns', type=str, nargs='+', default=None,
+        metavar="REGEX",
+        help="Regular expressions protected like glossaries, e.g. product codes")
+
+    parser.add_argument(
+        '--glossary-longest-match', action="store_true",
+        help="Isolate overlapping glossaries by leftmost longest match in a single scan, "+
+             "instead of splitting by each glossary in the given order")
+
+    parser.add_argument(
+        '--engine', type=str, default='heap', choices=sorted(MERGE_ENGINES),
+        help="Algorithm applying the merge operations, both give the same segmentation (default: %(default)s)")
+
+    parser.add_argument(
+        '--num-workers', type=int, default=1,
+        metavar="INT",
+        help="Segment the input in this many processes, output keeps input order (default: %(default)s)")
+
+    parser.add_argument(
+        '--block-size', type=int, default=10000,
+        metavar="INT",
+        help="Number of lines sent to a worker at once if --num-workers > 1 (default: %(default)s)")
+
+    parser.add_argument(
+        '--cache-size', type=int, default=1000000,
+        metavar="INT",
+        help="Maximum number of words kept in the segmentation cache, 0 for unbounded (default: %(default)s)")
+
+    parser.add_argument(
+        '--cache-file', type=str, default=None,
+        metavar="PATH",
+        help="Preload the segmentation cache from this file if it matches the codes and options, "+
+             "and save the warmed cache to it at the end")
+
     return parser
 
 
+def read_codes(codes, merges=-1):
+    """Read version and list of merge operations from text codes file (created by learn_bpe.py)"""
+
+    codes.seek(0)
+
+    # check version information
+    firstline = codes.readline()
+    if firstline.startswith('# version'):
+        version = firstline.strip().split()[-1]
+    else:
+        version = 'unknown'
+        codes.seek(0)
+
+    # limited by number of merge
+    pairs = [tuple(item.split()) for (n, item) in enumerate(codes) if (n < merges or merges == -1)]
+
+    return version, pairs
+
+
+def build_codes(pairs):
+    """Return dicts from pair to rank and from merged symbol to pair"""
+
+    # some hacking to deal with duplicates (only consider first instance)
+    bpe_codes = dict([(code,i) for (i,code) in reversed(list(enumerate(pairs)))])
+
+    bpe_codes_reverse = dict([(pair[0] + pair[1], pair) for pair,i in bpe_codes.items()])
+
+    return bpe_codes, bpe_codes_reverse
+
+
+# first bytes of a codes file written by compile_codes
+COMPILED_MAGIC = b'BPECODES3\n'
+
+# first bytes of the formats of earlier versions, no longer loaded
+COMPILED_MAGIC_OLD = (b'BPECODES1\n', b'BPECODES2\n')
+
+
+def _int_array(values, typecode='i'):
+    """Little-endian bytes of values, int32 or other array typecode"""
+    values = array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def _read_int_array(buf, pos, count, typecode='i'):
+    """Return count values of buf at pos, and position after them"""
+    values = array(typecode)
+    end = pos + values.itemsize * count
+    values.frombytes(buf[pos:end])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values, end
+
+
+def _int_view(buf, pos, count):
+    """Return count int32 of buf at pos, read in place if the byte order allows, and position after them"""
+    if sys.byteorder == 'big':
+        return _read_int_array(buf, pos, count)
+    end = pos + 4 * count
+    return memoryview(buf)[pos:end].cast('i'), end
+
+
+def _padding(size):
+    """Zero bytes after size bytes, so that the next ints are aligned"""
+    return b'\0' * (-size % 4)
+
+
+def _write_strings(f, strings):
+    """Write number of strings, their total and each length in bytes, and their concatenated UTF-8"""
+    items = [string.encode('UTF-8') for string in strings]
+    data = b''.join(items)
+    f.write(_int_array([len(items), len(data)]))
+    f.write(_int_array([len(item) for item in items]))
+    f.write(data + _padding(len(data)))
+
+
+def _read_strings(buf, pos):
+    """Return strings written by _write_strings at pos, and position after them"""
+    (count, size), pos = _read_int_array(buf, pos, 2)
+    lengths, pos = _read_int_array(buf, pos, count)
+    strings = []
+    for length in lengths:
+        strings.append(str(buf[pos:pos+length], 'UTF-8'))
+        pos += length
+    return strings, pos + len(_padding(size))
+
+
+def _skip_strings(buf, pos):
+    """Return position after strings written by _write_strings at pos, without reading them"""
+    (count, size), pos = _read_int_array(buf, pos, 2)
+    return pos + 4 * count + size + len(_padding(size))
+
+
+def _write_table(f, keys, values):
+    """Write hash table of string keys to int or string values, read in place by MappedTable
+
+    int32 number of keys, number of slots (twice the number of keys) and 1 if values are strings,
+    offsets of keys (and of values) in their concatenated UTF-8, or int values, crc32 of the UTF-8 of each key,
+    then the slots: index of each key at its crc32 modulo the number of slots, or at the next free slot, -1 if empty.
+    The concatenated keys (and values), each followed by a newline, come last.
+    """
+    keys = [key.encode('UTF-8') for key in keys]
+    is_str = bool(values) and isinstance(values[0], str)
+    if is_str:
+        values = [value.encode('UTF-8') for value in values]
+
+    # crc32 as int32, like they are read
+    hashes = array('i', array('I', [zlib.crc32(key) for key in keys]).tobytes())
+    num_slot = 2 * len(keys) + 1
+    slots = array('i', [-1]) * num_slot
+    for k, key in enumerate(keys):
+        slot = (hashes[k] & 0xFFFFFFFF) % num_slot
+        while slots[slot] >= 0:
+            slot = (slot + 1) % num_slot
+        slots[slot] = k
+
+    f.write(_int_array([len(keys), num_slot, int(is_str)]))
+    f.write(_int_array(accumulate([0] + [len(key) + 1 for key in keys])))
+    if is_str:
+        f.write(_int_array(accumulate([0] + [len(value) + 1 for value in values])))
+    else:
+        f.write(_int_array(values))
+    f.write(_int_array(hashes))
+    f.write(_int_array(slots))
+    for items in ([keys, values] if is_str else [keys]):
+        data = b''.join(item + b'\n' for item in items)
+        f.write(data + _padding(len(data)))
+
+
+class MappedTable(object):
+    """Hash table written by _write_table, looked up in place in buf (the mmap of the file, shared by processes)"""
+
+    def __init__(self, buf, pos):
+        (count, num_slot, is_str), pos = _read_int_array(buf, pos, 3)
+        self.count = count
+        self.num_slot = num_slot
+        self.key_offsets, pos = _int_view(buf, pos, count + 1)
+        if is_str:
+            self.value_offsets, pos = _int_view(buf, pos, count + 1)
+        else:
+            self.values, pos = _int_view(buf, pos, count)
+        self.hashes, pos = _int_view(buf, pos, count)
+        self.slots, pos = _int_view(buf, pos, num_slot)
+
+        size = self.key_offsets[count]
+        self.keys = memoryview(buf)[pos:pos+size]
+        pos += size + len(_padding(size))
+        self.value_data = None
+        if is_str:
+            size = self.value_offsets[count]
+            self.value_data = memoryview(buf)[pos:pos+size]
+            pos += size + len(_padding(size))
+
+        # position after the table
+        self.end = pos
+
+    def get(self, key):
+        """Return value of key, None if absent"""
+        data = key.encode('UTF-8')
+        slots = self.slots
+        hashes = self.hashes
+        offsets = self.key_offsets
+        num_slot = self.num_slot
+        crc = zlib.crc32(data)
+        # int32 as stored
+        signed = crc - (1 << 32) if crc >= 1 << 31 else crc
+        slot = crc % num_slot
+        while True:
+            k = slots[slot]
+            if k < 0:
+                return None
+            if hashes[k] == signed and self.keys[offsets[k]:offsets[k+1]-1] == data:
+                break
+            slot = (slot + 1) % num_slot
+
+        if self.value_data is None:
+            return self.values[k]
+        return str(self.value_data[self.value_offsets[k]:self.value_offsets[k+1]-1], 'UTF-8')
+
+    def all_keys(self):
+        return str(self.keys, 'UTF-8').split('\n')[:-1]
+
+    def all_values(self):
+        if self.value_data is None:
+            return self.values.tolist()
+        return str(self.value_data, 'UTF-8').split('\n')[:-1]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.all_keys())
+
+
+class _TableMemo(dict):
+    """Values found so far by a mapped dict (MappedCodes or MappedSplits) in its table, None if absent
+
+    after about len(table) / 8 lookups in place, reading the whole table costs less than going on,
+    so it is read at once into a dict, whose get becomes the lookup of the mapped dict
+    """
+
+    def __init__(self, mapped):
+        self.mapped = mapped
+        self.budget = len(mapped.table) // 8
+        self.values = None
+
+    def __missing__(self, key):
+        if self.budget > 0:
+            self.budget -= 1
+            value = self[key] = self.mapped.find(key)
+            return value
+        if self.values is None:
+            self.values = dict(self.mapped.read_all())
+            self.mapped.lookup = self.values.get
+        return self.values.get(key)
+
+
+class MappedCodes(object):
+    """bpe_codes of a compiled codes file: rank of pair looked up in its MappedTable
+
+    lookup(pair) is like get(pair), as a dict lookup in C once the pair was seen, used by merge_word_heap
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.lookup = _TableMemo(self).__getitem__
+
+    def find(self, pair):
+        return self.table.get(pair[0] + ' ' + pair[1])
+
+    def read_all(self):
+        return zip([tuple(key.split(' ')) for key in self.table.all_keys()], self.table.all_values())
+
+    def get(self, pair, default=None):
+        rank = self.lookup(pair)
+        return default if rank is None else rank
+
+    def __contains__(self, pair):
+        return self.lookup(pair) is not None
+
+    def __len__(self):
+        return len(self.table)
+
+    def items(self):
+        return self.read_all()
+
+
+class MappedSplits(object):
+    """Dict of a compiled codes file from symbol to tuple of symbols (bpe_codes_reverse, oov splits),
+    looked up in its MappedTable"""
+
+    def __init__(self, table):
+        self.table = table
+        self.lookup = _TableMemo(self).__getitem__
+
+    def find(self, symbol):
+        split = self.table.get(symbol)
+        return tuple(split.split(' ')) if split is not None else None
+
+    def read_all(self):
+        return zip(self.table.all_keys(), [tuple(split.split(' ')) for split in self.table.all_values()])
+
+    def get(self, symbol, default=None):
+        split = self.lookup(symbol)
+        return default if split is None else split
+
+    def __getitem__(self, symbol):
+        split = self.lookup(symbol)
+        if split is None:
+            raise KeyError(symbol)
+        return split
+
+    def __contains__(self, symbol):
+        return self.lookup(symbol) is not None
+
+    def __len__(self):
+        return len(self.table)
+
+    def __iter__(self):
+        return iter(self.table)
+
+
+def compile_codes(codes, output_path, merges=-1, vocab=None, separator='@@'):
+    """Write text codes file (and optionally vocabulary from read_vocabulary) to a binary file, loaded by load_compiled_codes
+
+    the file holds the version and separator, the merges, and the tables queried by BPE, looked up in place:
+    rank of each pair, pair of each merged symbol, and for the vocabulary, its words and the splits of oov symbols
+    by build_oov_splits with separator. the tables of vocabulary are marked absent by -1 if there is none.
+    loading it does not parse the codes or build any table, and runs no code from the file.
+    """
+    version, pairs = read_codes(codes, merges)
+    bpe_codes, bpe_codes_reverse = build_codes(pairs)
+
+    with open(output_path, 'wb') as f:
+        f.write(COMPILED_MAGIC)
+        _write_strings(f, [version, separator])
+        _write_strings(f, [' '.join(pair) for pair in pairs])
+        _write_table(f, [' '.join(pair) for pair in bpe_codes], list(bpe_codes.values()))
+        _write_table(f, list(bpe_codes_reverse), [' '.join(pair) for pair in bpe_codes_reverse.values()])
+        if vocab is None:
+            f.write(_int_array([-1]))
+        else:
+            internal, final = build_oov_splits(bpe_codes_reverse, vocab, separator)
+            _write_table(f, sorted(vocab), [0] * len(vocab))
+            for splits in (internal, final):
+                _write_table(f, list(splits), [' '.join(split) for split in splits.values()])
+
+
+def load_compiled_codes(codes):
+    """Return the tables of codes if it is a file written by compile_codes, otherwise None
+
+    a dict of version, separator, num_pairs, function pairs returning the list of merges (read only if called),
+    bpe_codes, bpe_codes_reverse, and vocab and oov_splits (None if no vocabulary),
+    all looked up in a read-only mmap of the file, so its pages are shared by the processes loading it.
+    """
+    path = getattr(codes, 'name', None)
+    if not isinstance(path, str) or not os.path.isfile(path):
+        return None
+
+    with open(path, 'rb') as f:
+        magic = f.read(len(COMPILED_MAGIC))
+        if magic in COMPILED_MAGIC_OLD:
+            raise ValueError('{0} was compiled by an earlier version, compile it again with compile_bpe.py'.format(path))
+        if magic != COMPILED_MAGIC:
+            return None
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    (version, separator), pos = _read_strings(buf, len(COMPILED_MAGIC))
+    pairs_pos = pos
+    (num_pairs,), _ = _read_int_array(buf, pos, 1)
+    pos = _skip_strings(buf, pos)
+
+    def pairs():
+        return [tuple(pair.split(' ')) for pair in _read_strings(buf, pairs_pos)[0]]
+
+    tables = []
+    for _ in range(2):
+        tables.append(MappedTable(buf, pos))
+        pos = tables[-1].end
+    (has_vocab,), _ = _read_int_array(buf, pos, 1)
+    if has_vocab >= 0:
+        for _ in range(3):
+            tables.append(MappedTable(buf, pos))
+            pos = tables[-1].end
+
+    return {'version': version, 'separator': separator, 'num_pairs': num_pairs, 'pairs': pairs,
+            'bpe_codes': MappedCodes(tables[0]), 'bpe_codes_reverse': MappedSplits(tables[1]),
+            'vocab': tables[2] if has_vocab >= 0 else None,
+            'oov_splits': (MappedSplits(tables[3]), MappedSplits(tables[4])) if has_vocab >= 0 else None}
+
+
 def get_pairs(word):
     """Return set of symbol pairs in a word.
 
@@ -147,31 +694,15 @@ def get_pairs(word):
     return pairs
 
 
-def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache, glossaries=None):
-    """Encode word based on list of BPE merge operations, which are applied consecutively
-    """
-
-    # if already in cache
-    if orig in cache:
-        return cache[orig]
+def merge_word(word, bpe_codes):
+    """Apply BPE merge operations to word (tuple of symbols) by repeatedly merging the best ranked pair
 
-    # same subword in glossary
-    if orig in glossaries:
-        cache[orig] = (orig,)
-        return (orig,)
-
-    # tuple of char and last char with '</w>'
-    if version.startswith('0.2.'):
-        word = tuple(orig[:-1]) + (orig[-1]+'</w>',)
-    else:
-        raise NotImplementedError
+    each step scans all pairs, so the cost is quadratic in word length
+    """
 
     # set of bigram
     pairs = get_pairs(word)
 
-    if not pairs:
-        return orig
-
     while True:
         
         bigram = min(pairs, key=lambda pair: bpe_codes.get(pair, float('inf')))
@@ -211,6 +742,105 @@ def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache,
         else:
             pairs = get_pairs(word)
 
+    return word
+
+
+def merge_word_heap(word, bpe_codes):
+    """Apply BPE merge operations to word (tuple of symbols), same result as merge_word
+
+    symbols are kept in a linked list, and adjacent pairs in a heap ordered by rank then position.
+    all occurrences of the best ranked pair are merged left to right before the pairs they create are considered,
+    like one step of merge_word, so the cost is O(n log n) in word length.
+    """
+    symbols = list(word)
+    n = len(symbols)
+    # linked list by position, merged symbol is kept at position of its left part
+    nxt = list(range(1, n+1))
+    prv = list(range(-1, n-1))
+
+    # lookup of MappedCodes, which gives None for pairs that are not codes, like get
+    get = getattr(bpe_codes, 'lookup', bpe_codes.get)
+
+    heap = []
+    for i in range(n-1):
+        pair = (symbols[i], symbols[i+1])
+        rank = get(pair)
+        if rank is not None:
+            heap.append((rank, i, pair))
+    heapq.heapify(heap)
+
+    while heap:
+        rank, i, pair = heapq.heappop(heap)
+        occurrences = [i]
+        # same rank means same pair, popped by position
+        while heap and heap[0][0] == rank:
+            occurrences.append(heapq.heappop(heap)[1])
+
+        first, second = pair
+        new_symbol = first + second
+        merged = []
+        for i in occurrences:
+            j = nxt[i]
+            # outdated: symbol already merged into its left neighbour, or pair changed
+            if symbols[i] != first or j >= n or symbols[j] != second:
+                continue
+            symbols[i] = new_symbol
+            symbols[j] = None
+            nxt[i] = nxt[j]
+            if nxt[j] < n:
+                prv[nxt[j]] = i
+            merged.append(i)
+
+        # pairs around new symbols
+        for i in merged:
+            if symbols[i] is None:
+                continue
+            for left, right in ((prv[i], i), (i, nxt[i])):
+                if left < 0 or right >= n:
+                    continue
+                pair = (symbols[left], symbols[right])
+                rank = get(pair)
+                if rank is not None:
+                    heapq.heappush(heap, (rank, left, pair))
+
+    return tuple([symbol for symbol in symbols if symbol is not None])
+
+
+# algorithms to apply merge operations to a word
+MERGE_ENGINES = {'classic': merge_word, 'heap': merge_word_heap}
+
+
+def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache, glossaries=None, merge=merge_word_heap,
+           oov_splits=None):
+    """Encode word based on list of BPE merge operations, which are applied consecutively
+
+    merge is the function applying the merge operations to the tuple of symbols (see MERGE_ENGINES)
+    oov_splits are the tables of build_oov_splits for vocab, used instead of splitting each oov subword again
+    """
+
+    # if already in cache
+    cached = cache.get(orig)
+    if cached is not None:
+        return cached
+
+    # same subword in glossary
+    if orig in glossaries:
+        cache[orig] = (orig,)
+        return (orig,)
+
+    # tuple of char and last char with '</w>'
+    if version.startswith('0.2.'):
+        word = tuple(orig[:-1]) + (orig[-1]+'</w>',)
+    else:
+        raise NotImplementedError
+
+    # single character
+    if len(word) == 1:
+        cache[orig] = (orig,)
+        return (orig,)
+
+    word = merge(word, bpe_codes)
+
     # do not print end-of-word symbols
     if word[-1] == '</w>':
         word = word[:-1]
@@ -218,7 +848,9 @@ def encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, cache,
         word = word[:-1] + (word[-1].replace('</w>',''),)
 
     # reverse merge for oov
-    if vocab:
+    if oov_splits is not None:
+        word = split_oov(word, oov_splits)
+    elif vocab:
         word = check_vocab_and_split(word, bpe_codes_reverse, vocab, separator)
 
     cache[orig] = word
@@ -280,6 +912,38 @@ def check_vocab_and_split(orig, bpe_codes_reverse, vocab, separator):
     return out
 
 
+def build_oov_splits(bpe_codes_reverse, vocab, separator):
+    """Return splits of merged symbols by check_vocab_and_split, for word-internal and word-final subwords
+
+    only oov symbols that can be split are in the tables, any other subword is kept as is
+    """
+    internal = {}
+    final = {}
+
+    for segment in bpe_codes_reverse:
+        if segment + separator not in vocab:
+            internal[segment] = tuple(recursive_split(segment, bpe_codes_reverse, vocab, separator, False))
+        # final subwords are merged with end-of-word
+        if segment.endswith('</w>'):
+            segment = segment[:-4]
+            if segment not in vocab:
+                final[segment] = tuple(recursive_split(segment, bpe_codes_reverse, vocab, separator, True))
+
+    return internal, final
+
+
+def split_oov(orig, oov_splits):
+    """Same as check_vocab_and_split, with the tables of build_oov_splits"""
+    internal, final = oov_splits
+
+    out = []
+    for segment in orig[:-1]:
+        out.extend(internal.get(segment, (segment,)))
+    out.extend(final.get(orig[-1], (orig[-1],)))
+
+    return out
+
+
 def read_vocabulary(vocab_file, threshold):
     """read vocabulary file produced by get_vocab.py, and filter according to frequency threshold.
     """
@@ -312,6 +976,167 @@ def isolate_glossary(word, glossary):
         return segments + [splits[-1].strip()] if splits[-1] != '' else segments
 
 
+def glossary_trie_regex(glossaries):
+    """Build a regular expression matching any of the glossaries, as a prefix trie
+
+    at a given position the longest glossary is matched, and the cost of a match
+    does not grow with the number of glossaries
+    """
+    trie = {}
+    for gloss in glossaries:
+        if not gloss:
+            continue
+        node = trie
+        for char in gloss:
+            node = node.setdefault(char, {})
+        # end of a glossary
+        node[''] = {}
+
+    def to_regex(node):
+        branches = [re.escape(char) + to_regex(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        # glossary ends here, but try the longer ones first
+        if '' in node:
+            return '(?:' + body + ')?'
+        return body
+
+    return to_regex(trie)
+
+
+class GlossaryMatcher(object):
+    """Glossaries and glossary patterns compiled into regular expressions
+
+    By default isolate() gives the same segments as applying isolate_glossary for each glossary in turn,
+    in the order of glossaries, so overlapping glossaries split as before; only the glossaries found in the word are applied.
+    Glossary patterns then isolate their matches in the segments which are not glossaries.
+
+    With longest_match, a word is split in a single scan instead: at the leftmost position where a glossary or pattern matches,
+    the longest glossary (then the first matching pattern) is isolated, and isolated parts are not split again.
+    """
+
+    def __init__(self, glossaries=None, patterns=None, longest_match=False):
+        self.longest_match = longest_match
+
+        # position of each glossary, glossaries are applied in this order
+        self.order = {}
+        for k, gloss in enumerate(glossaries or []):
+            if gloss:
+                self.order.setdefault(gloss, k)
+        self.max_length = max(map(len, self.order), default=0)
+
+        literal = glossary_trie_regex(self.order)
+        patterns = ['(?:' + pattern + ')' for pattern in patterns or []]
+        alternatives = [alt for alt in [literal] + patterns if alt]
+
+        self.regex = re.compile('|'.join(alternatives)) if alternatives else None
+        self.literal_regex = re.compile(literal) if literal else None
+        self.pattern_regex = re.compile('|'.join(patterns)) if patterns else None
+
+    def __bool__(self):
+        return self.regex is not None
+
+    def __contains__(self, word):
+        """True if the whole word is a glossary"""
+        return self.regex is not None and self.regex.fullmatch(word) is not None
+
+    def isolate(self, word):
+        """Return list of subwords, in which all glossaries are isolated"""
+        if self.regex is None:
+            return [word]
+
+        if self.longest_match:
+            return self._scan(self.regex, word)
+
+        segments = [word]
+        if self.literal_regex is not None and self.literal_regex.search(word):
+            segments = self._isolate_in_order(word)
+
+        if self.pattern_regex is not None:
+            segments = [out for segment in segments
+                        for out in ([segment] if segment in self.order else self._scan(self.pattern_regex, segment))]
+
+        return segments
+
+    def _isolate_in_order(self, word):
+        # splitting only gives substrings of word, so no other glossary can be found in the segments
+        order = self.order
+        present = set()
+        for i in range(len(word)):
+            for j in range(i + 1, min(len(word), i + self.max_length) + 1):
+                if word[i:j] in order:
+                    present.add(word[i:j])
+
+        segments = [word]
+        for gloss in sorted(present, key=order.get):
+            segments = [out for segment in segments for out in isolate_glossary(segment, gloss)]
+        return segments
+
+    @staticmethod
+    def _scan(regex, word):
+        segments = []
+        start = 0
+        for match in regex.finditer(word):
+            # skip empty match of a pattern
+            if match.end() == match.start():
+                continue
+            segment = word[start:match.start()].strip()
+            if segment:
+                segments.append(segment)
+            segments.append(match.group())
+            start = match.end()
+
+        if not segments:
+            return [word]
+
+        segment = word[start:].strip()
+        if segment:
+            segments.append(segment)
+        return segments
+
+
+# BPE instance of a worker process
+_worker_bpe = None
+
+
+def _init_worker(codes_path, merges, separator, vocab, glossaries, cache_size, cache_file, engine, glossary_patterns,
+                 glossary_longest_match):
+    """Build the BPE instance (and its cache) of a worker process"""
+    global _worker_bpe
+    with open(codes_path, encoding='UTF-8') as codes:
+        _worker_bpe = BPE(codes, merges, separator, vocab, glossaries, cache_size, engine, glossary_patterns,
+                          glossary_longest_match)
+    if cache_file and os.path.exists(cache_file):
+        _worker_bpe.load_cache(cache_file)
+
+
+def _segment_block(lines):
+    return ''.join([_worker_bpe.segment_line(line) for line in lines])
+
+
+def segment_parallel(infile, outfile, codes_path, num_workers, merges=-1, separator='@@', vocab=None, glossaries=None, block_size=10000,
+                     cache_size=None, cache_file=None, engine='heap', glossary_patterns=None, glossary_longest_match=False):
+    """Segment infile to outfile with a pool of num_workers processes, each holding its own BPE.
+
+    lines are sent to workers in blocks of block_size, and written back in input order.
+    at most two blocks per worker are in flight, so memory does not grow with the input.
+    each worker preloads cache_file if given (it is not written back).
+    """
+    blocks = iter(lambda: list(islice(infile, block_size)), [])
+    initargs = (codes_path, merges, separator, vocab, glossaries, cache_size, cache_file, engine, glossary_patterns,
+                glossary_longest_match)
+    pending = deque()
+
+    with multiprocessing.Pool(num_workers, _init_worker, initargs) as pool:
+        for block in blocks:
+            pending.append(pool.apply_async(_segment_block, (block,)))
+            if len(pending) >= 2 * num_workers:
+                outfile.write(pending.popleft().get())
+        while pending:
+            outfile.write(pending.popleft().get())
+
+
 if __name__ == '__main__':
 
     parser = create_parser()
@@ -322,19 +1147,25 @@ if __name__ == '__main__':
     else:
         vocabulary = None
 
-    # get bpe codes
-    bpe = BPE(args.codes, args.merges, args.separator, vocabulary, args.glossaries)
+    cache_size = args.cache_size if args.cache_size > 0 else None
 
-    for line in args.input:
+    if args.num_workers > 1:
+        segment_parallel(args.input, args.output, args.codes.name, args.num_workers,
+                         args.merges, args.separator, vocabulary, args.glossaries, args.block_size,
+                         cache_size, args.cache_file, args.engine, args.glossary_patterns, args.glossary_longest_match)
+    else:
+        # get bpe codes
+        bpe = BPE(args.codes, args.merges, args.separator, vocabulary, args.glossaries, cache_size, args.engine,
+                  args.glossary_patterns, args.glossary_longest_match)
 
-        # keep leading whitespace
-        leading_whitespace = len(line)-len(line.lstrip())
-        if leading_whitespace:
-            args.output.write(line[:leading_whitespace])
+        if args.cache_file and os.path.exists(args.cache_file):
+            if not bpe.load_cache(args.cache_file):
+                sys.stderr.write('Cache file {0} does not match codes and options, ignored\n'.format(args.cache_file))
 
-        args.output.write(bpe.segment(line.strip()))
+        for line in args.input:
+            args.output.write(bpe.segment_line(line))
 
-        # keep trailing whitespace
-        trailing_whitespace = len(line)-len(line.rstrip())
-        if trailing_whitespace:
-            args.output.write(line[-trailing_whitespace:])
+        if args.cache_file:
+            bpe.save_cache(args.cache_file)
+            sys.stderr.write('Segmentation cache: {0} hits, {1} misses, {2} words saved\n'.format(
+                bpe.cache.hits, bpe.cache.misses, len(bpe.cache)))
@@ -0,0 +1,289 @@
+"""Benchmark learn_bpe.py, apply_bpe.py and learn_joint_bpe_and_vocab.py on synthetic corpora.
+Word frequencies of the generated corpora follow a Zipf distribution, and the same seed always gives the same corpus,
+so results of different versions of the code can be compared.
+Each benchmark runs several times, each time in a fresh process to measure its own peak memory,
+and the best value of each metric is kept, as a single run is too noisy to compare.
+Results are written as JSON, and compared against a saved baseline to flag regressions.
+"""
+
+# python3 only
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import statistics
+import tempfile
+import subprocess
+import multiprocessing
+from itertools import accumulate
+
+# local module
+import learn_bpe
+import apply_bpe
+
+
+def create_parser():
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="benchmark BPE learning and segmentation")
+
+    parser.add_argument(
+        '--output', '-o', type=str, metavar='PATH', required=True,
+        help="Output file for JSON results (required)")
+
+    parser.add_argument(
+        '--baseline', '-b', type=str, default=None, metavar='PATH',
+        help="JSON results of a previous run, regressions are reported and the exit status is 1")
+
+    parser.add_argument(
+        '--tolerance', type=float, default=0.1, metavar='FLOAT',
+        help="Relative slowdown or memory growth against the baseline reported as regression (default: %(default)s)")
+
+    parser.add_argument(
+        '--lines', type=int, default=200000, metavar='INT',
+        help="Number of lines of generated corpus (default: %(default)s)")
+
+    parser.add_argument(
+        '--words-per-line', type=int, default=20, metavar='INT',
+        help="Average number of words per line (default: %(default)s)")
+
+    parser.add_argument(
+        '--vocab-size', type=int, default=50000, metavar='INT',
+        help="Number of distinct words of generated corpus (default: %(default)s)")
+
+    parser.add_argument(
+        '--zipf', type=float, default=1.1, metavar='FLOAT',
+        help="Exponent of the Zipf distribution of word frequencies (default: %(default)s)")
+
+    parser.add_argument(
+        '--symbols', '-s', type=int, default=5000, metavar='INT',
+        help="Number of merges learned (default: %(default)s)")
+
+    parser.add_argument(
+        '--repeat', '-r', type=int, default=5, metavar='INT',
+        help="Number of runs of each benchmark, the best value of each metric is compared (default: %(default)s)")
+
+    parser.add_argument(
+        '--seed', type=int, default=1234, metavar='INT',
+        help="Random seed of generated corpus (default: %(default)s)")
+
+    parser.add_argument(
+        '--workdir', type=str, default=None, metavar='PATH',
+        help="Directory for corpora and codes (default: temporary directory)")
+
+    return parser
+
+
+def generate_corpus(path, num_lines, words_per_line, vocab_size, zipf, seed):
+    """Write tokenized text whose word frequencies follow a Zipf distribution"""
+    rng = random.Random(seed)
+    alphabet = 'abcdefghijklmnopqrstuvwxyzéèàç'
+
+    # word lengths roughly like natural language, frequent words are short
+    words = set()
+    while len(words) < vocab_size:
+        length = min(2 + int(rng.expovariate(0.3)) + len(words) * 8 // vocab_size, 25)
+        words.add(''.join(rng.choice(alphabet) for _ in range(length)))
+    words = sorted(words, key=lambda word: (len(word), word))
+
+    cum_weights = list(accumulate(1.0 / (rank+1) ** zipf for rank in range(vocab_size)))
+
+    num_tokens = 0
+    with open(path, 'w', encoding='UTF-8') as f:
+        for _ in range(num_lines):
+            line = rng.choices(words, cum_weights=cum_weights, k=rng.randint(1, 2 * words_per_line - 1))
+            num_tokens += len(line)
+            f.write(' '.join(line))
+            f.write('\n')
+
+    return num_tokens
+
+
+def peak_rss_kb():
+    """Peak resident memory of this process, in KB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def bench_learn(corpus, codes, num_symbols, compact=False):
+    """Time learning codes on corpus"""
+    with open(corpus, encoding='UTF-8') as infile, open(codes, 'w', encoding='UTF-8') as outfile:
+        start = time.time()
+        learn_bpe.main(infile, outfile, num_symbols, compact=compact)
+        seconds = time.time() - start
+
+    with open(codes, encoding='UTF-8') as f:
+        num_merges = sum(1 for line in f if not line.startswith('#'))
+
+    return {'seconds': seconds, 'merges': num_merges, 'merges_per_sec': num_merges / seconds}
+
+
+def bench_apply(corpus, codes, vocab_path=None, glossaries=None):
+    """Time segmenting corpus with cold then warm cache"""
+    with open(corpus, encoding='UTF-8') as f:
+        lines = [line.strip() for line in f]
+    num_tokens = sum(len(line.split()) for line in lines)
+
+    vocab = None
+    if vocab_path:
+        with open(vocab_path, encoding='UTF-8') as f:
+            vocab = apply_bpe.read_vocabulary(f, 2)
+
+    start = time.time()
+    with open(codes, encoding='UTF-8') as f:
+        bpe = apply_bpe.BPE(f, vocab=vocab, glossaries=glossaries)
+    result = {'load_seconds': time.time() - start}
+
+    for name in ('cold', 'warm'):
+        start = time.time()
+        for line in lines:
+            bpe.segment(line)
+        seconds = time.time() - start
+        result[name + '_seconds'] = seconds
+        result[name + '_tokens_per_sec'] = num_tokens / seconds
+
+    return result
+
+
+def bench_joint(corpora, codes, vocabs, num_symbols):
+    """Time learn_joint_bpe_and_vocab.py (in a subprocess, as it has no function interface)"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'learn_joint_bpe_and_vocab.py')
+    start = time.time()
+    subprocess.check_call([sys.executable, script, '--input'] + corpora +
+                          ['--output', codes, '--symbols', str(num_symbols), '--write-vocabulary'] + vocabs,
+                          stderr=subprocess.DEVNULL)
+    seconds = time.time() - start
+
+    # the work is done by the child
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {'seconds': seconds, 'child_peak_rss_kb': rss // 1024 if sys.platform == 'darwin' else rss}
+
+
+def _run(conn, func, args):
+    result = func(*args)
+    result['peak_rss_kb'] = peak_rss_kb()
+    conn.send(result)
+    conn.close()
+
+
+def run_isolated(func, *args):
+    """Run benchmark func in a fresh process, return its results with peak memory"""
+    context = multiprocessing.get_context('spawn')
+    conn, child_conn = context.Pipe()
+    process = context.Process(target=_run, args=(child_conn, func, args))
+    process.start()
+    result = conn.recv()
+    process.join()
+    return result
+
+
+def run_repeated(repeat, func, *args):
+    """Run benchmark func repeat times, return best value of each metric, with median of compared metrics"""
+    runs = [run_isolated(func, *args) for _ in range(repeat)]
+
+    # noise of the machine only slows runs down, so the best run is the most stable to compare
+    result = {'runs': repeat}
+    for metric in runs[0]:
+        values = [run[metric] for run in runs]
+        result[metric] = max(values) if metric in HIGHER_IS_BETTER else min(values)
+        if metric in COMPARED and repeat > 1:
+            result[metric + '_median'] = statistics.median(values)
+    return result
+
+
+# metrics where higher is better, all others are lower is better
+HIGHER_IS_BETTER = ('merges_per_sec', 'cold_tokens_per_sec', 'warm_tokens_per_sec')
+
+# metrics compared against baseline (load time is too short to compare reliably)
+COMPARED = HIGHER_IS_BETTER + ('seconds', 'peak_rss_kb', 'child_peak_rss_kb')
+
+
+def compare(results, baseline, tolerance):
+    """Return list of regressions of results against baseline"""
+    regressions = []
+
+    for name, metrics in results['benchmarks'].items():
+        base_metrics = baseline.get('benchmarks', {}).get(name)
+        if not base_metrics:
+            continue
+        for metric in COMPARED:
+            if metric not in metrics or not base_metrics.get(metric):
+                continue
+            ratio = metrics[metric] / base_metrics[metric]
+            if metric in HIGHER_IS_BETTER:
+                regressed = ratio < 1 - tolerance
+            else:
+                regressed = ratio > 1 + tolerance
+            if regressed:
+                regressions.append('{0} {1}: {2:.4g} (baseline {3:.4g})'.format(name, metric, metrics[metric], base_metrics[metric]))
+
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = create_parser()
+    args = parser.parse_args()
+
+    tmpdir = None
+    if args.workdir:
+        workdir = args.workdir
+        os.makedirs(workdir, exist_ok=True)
+    else:
+        tmpdir = tempfile.TemporaryDirectory()
+        workdir = tmpdir.name
+
+    def path(name):
+        return os.path.join(workdir, name)
+
+    config = dict((key, value) for key, value in vars(args).items() if key not in ('output', 'baseline', 'workdir'))
+    results = {'config': config, 'python': sys.version.split()[0], 'benchmarks': {}}
+    benchmarks = results['benchmarks']
+
+    # two sides of a synthetic parallel corpus
+    sys.stderr.write('generating corpora\n')
+    num_tokens = generate_corpus(path('corpus.a'), args.lines, args.words_per_line, args.vocab_size, args.zipf, args.seed)
+    generate_corpus(path('corpus.b'), args.lines, args.words_per_line, args.vocab_size, args.zipf, args.seed + 1)
+    results['corpus_tokens'] = num_tokens
+
+    sys.stderr.write('learn\n')
+    benchmarks['learn'] = run_repeated(args.repeat, bench_learn, path('corpus.a'), path('codes'), args.symbols)
+    benchmarks['learn_compact'] = run_repeated(args.repeat, bench_learn, path('corpus.a'), path('codes.compact'), args.symbols, True)
+
+    sys.stderr.write('learn joint\n')
+    benchmarks['learn_joint'] = run_repeated(args.repeat, bench_joint, [path('corpus.a'), path('corpus.b')],
+                                             path('codes.joint'), [path('vocab.a'), path('vocab.b')], args.symbols)
+
+    # glossaries: some frequent words and some made up codes
+    with open(path('corpus.a'), encoding='UTF-8') as f:
+        glossaries = sorted(set(f.readline().split()))[:20] + ['X{0:04d}'.format(k) for k in range(1000)]
+
+    sys.stderr.write('apply\n')
+    benchmarks['apply'] = run_repeated(args.repeat, bench_apply, path('corpus.a'), path('codes'))
+    benchmarks['apply_vocab'] = run_repeated(args.repeat, bench_apply, path('corpus.a'), path('codes.joint'), path('vocab.a'))
+    benchmarks['apply_glossaries'] = run_repeated(args.repeat, bench_apply, path('corpus.a'), path('codes'), None, glossaries)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+    for name, metrics in sorted(benchmarks.items()):
+        sys.stderr.write('{0}: {1}\n'.format(name, ', '.join('{0}={1:.4g}'.format(k, v) for k, v in sorted(metrics.items()))))
+
+    if tmpdir is not None:
+        tmpdir.cleanup()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            sys.stderr.write('REGRESSION {0}\n'.format(regression))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,65 @@
+"""Compile BPE codes learned with learn_bpe.py (and optionally a vocabulary) to a binary file.
+apply_bpe.py accepts the compiled file in place of the text codes. The merge table, and the vocabulary with the splits
+of its oov symbols, are looked up in place in a read-only mmap of the file, so a process starts without parsing the codes
+or building any table, and the pages are shared by all the processes using the file.
+"""
+
+# python3 only
+
+import argparse
+
+# local module
+import apply_bpe
+
+
+def create_parser():
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="compile BPE codes to a binary merge table")
+
+    parser.add_argument(
+        '--codes', '-c', type=argparse.FileType('r', encoding='UTF-8'),
+        metavar='PATH', required=True,
+        help="File with BPE codes (created by learn_bpe.py)")
+
+    parser.add_argument(
+        '--output', '-o', type=str,
+        metavar='PATH', required=True,
+        help="Output file for the compiled codes (required)")
+
+    parser.add_argument(
+        '--merges', '-m', type=int, default=-1,
+        metavar='INT',
+        help="Use this many BPE operations (<= number of learned symbols)"+
+             "default: Apply all the learned merge operations")
+
+    parser.add_argument(
+        '--vocabulary', type=argparse.FileType('r', encoding='UTF-8'), default=None,
+        metavar="PATH",
+        help="Vocabulary file to store with the codes, used by apply_bpe.py if no --vocabulary is given.")
+
+    parser.add_argument(
+        '--vocabulary-threshold', type=int, default=None,
+        metavar="INT",
+        help="Vocabulary threshold. If vocabulary is provided, any word with frequency < threshold will be treated as OOV")
+
+    parser.add_argument(
+        '--separator', '-s', type=str, default='@@', metavar='STR',
+        help="Separator between non-final subword units of apply_bpe.py, the splits of oov symbols are stored for it "+
+             "(default: '%(default)s')")
+
+    return parser
+
+
+if __name__ == '__main__':
+
+    parser = create_parser()
+    args = parser.parse_args()
+
+    if args.vocabulary:
+        vocabulary = apply_bpe.read_vocabulary(args.vocabulary, args.vocabulary_threshold)
+    else:
+        vocabulary = None
+
+    apply_bpe.compile_codes(args.codes, args.output, args.merges, vocabulary, args.separator)
@@ -9,10 +9,16 @@ Proceedings of the 54th Annual Meeting of the Association for Computational Ling
 
 # python3 only
 
+import os
 import sys
 import re
-import copy
+import json
+import time
+import heapq
+import pickle
+import multiprocessing
 import argparse
+from array import array
 from collections import defaultdict, Counter
 
 
@@ -24,8 +30,8 @@ def create_parser():
 
     parser.add_argument(
         '--input', '-i', type=argparse.FileType('r', encoding='UTF-8'),
-        metavar='PATH', required=True, 
-        help="Input file (required)")
+        metavar='PATH',
+        help="Input file (required unless resuming from a checkpoint)")
 
     parser.add_argument(
         '--output', '-o', type=argparse.FileType('w', encoding='UTF-8'),
@@ -34,7 +40,7 @@ def create_parser():
 
     parser.add_argument(
         '--symbols', '-s', type=int, default=10000,
-        help="Create this many new symbols (each representing a character n-gram) (default: %(default)s))")
+        help="Create this many new symbols (each representing a character n-gram) (default: %(default)s)")
 
     parser.add_argument(
         '--min-frequency', type=int, default=2, metavar='FREQ',
@@ -43,6 +49,39 @@ def create_parser():
     parser.add_argument('--dict-input', action="store_true",
         help="If set, input file is interpreted as a dictionary where each line contains a word-count pair")
 
+    parser.add_argument(
+        '--num-workers', type=int, default=1, metavar='INT',
+        help="Count the vocabulary, compute pair statistics and apply the first (largest) merges in this many processes (default: %(default)s)")
+
+    parser.add_argument(
+        '--compact', action="store_true",
+        help="Intern symbols to integer ids to reduce memory and merge time on large vocabularies (same output)")
+
+    parser.add_argument(
+        '--checkpoint', type=str, default=None, metavar='PATH',
+        help="Periodically save the learning state to this file, and at the end")
+
+    parser.add_argument(
+        '--checkpoint-every', type=int, default=1000, metavar='INT',
+        help="Save a checkpoint every this many merges (default: %(default)s)")
+
+    parser.add_argument(
+        '--resume', type=str, default=None, metavar='PATH',
+        help="Continue learning up to --symbols merges from a checkpoint, or from a codes file "+
+             "replayed on the vocabulary of --input (must not be the output file)")
+
+    parser.add_argument(
+        '--profile', action="store_true",
+        help="Report time and calls of each learning phase and merge counters to stderr")
+
+    parser.add_argument(
+        '--profile-file', type=argparse.FileType('w', encoding='UTF-8'), default=None, metavar='PATH',
+        help="Write the profile reports to this file as JSON lines instead")
+
+    parser.add_argument(
+        '--profile-every', type=int, default=1000, metavar='INT',
+        help="Write a profile report every this many merges (default: %(default)s)")
+
     parser.add_argument(
         '--verbose', '-v', action="store_true",
         help="verbose mode.")
@@ -50,9 +89,14 @@ def create_parser():
     return parser
 
 
-def get_vocabulary(fobj, is_dict=False):
+def get_vocabulary(fobj, is_dict=False, num_workers=1):
     """Read text and return dictionary that encodes vocabulary
+
+    with num_workers > 1, a regular text file is split into chunks counted in parallel (see get_vocabulary_parallel)
     """
+    if num_workers > 1 and not is_dict and os.path.isfile(getattr(fobj, 'name', '')):
+        return get_vocabulary_parallel(fobj.name, num_workers, getattr(fobj, 'encoding', 'UTF-8'))
+
     vocab = Counter()
     for i, line in enumerate(fobj):
         if is_dict:
@@ -76,12 +120,75 @@ def get_vocabulary(fobj, is_dict=False):
     return vocab
 
 
-def update_pair_statistics(pair, changed, stats, indices):
+def get_chunk_offsets(path, num_chunks):
+    """Split file into at most num_chunks byte ranges, each starting at the beginning of a line"""
+    size = os.path.getsize(path)
+    offsets = [0]
+
+    with open(path, 'rb') as f:
+        for k in range(1, num_chunks):
+            f.seek(size * k // num_chunks)
+            # move to the start of next line
+            f.readline()
+            pos = f.tell()
+            if pos > offsets[-1] and pos < size:
+                offsets.append(pos)
+
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def _count_chunk(args):
+    """Count words of lines in byte range [start, end) of file"""
+    path, start, end, encoding = args
+    vocab = Counter()
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            # same universal newlines as reading in text mode
+            for subline in line.decode(encoding).replace('\r\n', '\n').replace('\r', '\n').split('\n'):
+                for word in subline.strip().split(' '):
+                    if word:
+                        vocab[word] += 1
+    return vocab
+
+
+def get_vocabulary_parallel(path, num_workers, encoding='UTF-8'):
+    """Count vocabulary of a tokenized text file in num_workers processes
+
+    the file is split into byte ranges on line boundaries, and the counters of the ranges are merged
+    in file order, so the result (including the order of words) is the same as get_vocabulary
+    """
+    # a few chunks per worker to balance the load, but not smaller than 1MB
+    num_chunks = max(1, min(num_workers * 4, os.path.getsize(path) // (1 << 20)))
+    chunks = [(path, start, end, encoding) for start, end in get_chunk_offsets(path, num_chunks)]
+
+    vocab = Counter()
+    if len(chunks) < 2:
+        for chunk in chunks:
+            vocab.update(_count_chunk(chunk))
+        return vocab
+
+    with multiprocessing.Pool(min(num_workers, len(chunks))) as pool:
+        for chunk_vocab in pool.imap(_count_chunk, chunks):
+            vocab.update(chunk_vocab)
+    return vocab
+
+
+def update_pair_statistics(pair, changed, stats, indices, queue=None):
     """Minimally update the indices and frequency of symbol pairs
 
     if we merge a pair of symbols, only pairs that overlap with occurrences
     of this pair are affected, and need to be updated.
+    if queue is given, every pair whose frequency changed is pushed to it.
     """
+    touched = set()
     stats[pair] = 0
     indices[pair] = defaultdict(int)
     first, second = pair
@@ -106,6 +213,7 @@ def update_pair_statistics(pair, changed, stats, indices):
                     prev = old_word[i-1:i+1]
                     stats[prev] -= freq
                     indices[prev][j] -= 1
+                    touched.add(prev)
 
                 # if pair is not last two symbol
                 if i < len(old_word)-2:
@@ -115,6 +223,7 @@ def update_pair_statistics(pair, changed, stats, indices):
                         nex = old_word[i+1:i+3]
                         stats[nex] -= freq
                         indices[nex][j] -= 1
+                        touched.add(nex)
                 i += 2
             else:
                 i += 1
@@ -132,14 +241,19 @@ def update_pair_statistics(pair, changed, stats, indices):
                 prev = word[i-1:i+1]
                 stats[prev] += freq
                 indices[prev][j] += 1
+                touched.add(prev)
             # assuming a symbol sequence "A BC B", if "B C" is merged, increase the frequency of "BC B"
             # however, if the sequence is A BC BC, skip this step because the count of "BC BC" will be incremented by the previous code block
             if i < len(word)-1 and word[i+1] != new_pair:
                 nex = word[i:i+2]
                 stats[nex] += freq
                 indices[nex][j] += 1
+                touched.add(nex)
             i += 1
 
+    if queue is not None:
+        queue.update(touched)
+
 
 def get_pair_statistics(vocab):
     """Count frequency of all symbol pairs, and create index"""
@@ -197,72 +311,638 @@ def replace_pair(pair, vocab, indices):
     return changes
 
 
-def prune_stats(stats, big_stats, threshold):
-    """Prune statistics dict for efficiency of max()
+class CompactVocabulary(object):
+    """Vocabulary with symbols interned to integer ids
 
-    The frequency of a symbol pair never increases, so pruning is generally safe
-    (until the most frequent pair is less frequent than a pair we previously pruned)
-    big_stats keeps full statistics for when we need to access pruned items
+    Each word is an array of symbol ids, and a pair of symbols is packed into a single int,
+    so stats and indices of get_pair_statistics are keyed by int instead of tuple of strings.
+    The index of a pair is an array of ids of words that may contain it: ids are appended when the pair
+    appears in a word, and words which no longer contain it are skipped when it is merged.
+    Merges are applied by scanning the word arrays in place.
     """
-    for item, freq in list(stats.items()):
-        if freq < threshold:
-            del stats[item]
-            # item already pruned when pair merge
-            if freq < 0:
-                big_stats[item] += freq
-            # update freq in complete stats
+
+    # bits of second symbol in a packed pair
+    shift = 32
+    mask = (1 << 32) - 1
+
+    def __init__(self, vocab):
+        self.symbols = []
+        self.symbol_ids = {}
+        self.words = []
+        self.freqs = []
+
+        for word, freq in vocab:
+            self.words.append(array('i', [self.intern(char) for char in word]))
+            self.freqs.append(freq)
+
+    @classmethod
+    def from_state(cls, state):
+        """Restore vocabulary from get_state()"""
+        compact_vocab = cls([])
+        for symbol in state['symbols']:
+            compact_vocab.intern(symbol)
+        compact_vocab.words = state['words']
+        compact_vocab.freqs = state['freqs']
+        return compact_vocab
+
+    def get_state(self):
+        """Return picklable state of the vocabulary"""
+        return {'symbols': self.symbols, 'words': self.words, 'freqs': self.freqs}
+
+    def intern(self, symbol):
+        """Return id of symbol, assign a new one if unseen"""
+        idx = self.symbol_ids.get(symbol)
+        if idx is None:
+            idx = len(self.symbols)
+            self.symbol_ids[symbol] = idx
+            self.symbols.append(symbol)
+        return idx
+
+    def pair_symbols(self, pair):
+        """Unpack pair to tuple of symbol strings"""
+        return self.symbols[pair >> self.shift], self.symbols[pair & self.mask]
+
+    @staticmethod
+    def add_index(indices, pair, j):
+        """Add word j to index of pair, unless it was the last one added"""
+        index = indices.get(pair)
+        if index is None:
+            indices[pair] = array('i', (j,))
+        elif index[-1] != j:
+            index.append(j)
+
+    def get_pair_statistics(self):
+        """Count frequency of all symbol pairs, and create index"""
+        stats = defaultdict(int)
+        indices = {}
+        add_index = self.add_index
+        shift = self.shift
+
+        for i, (word, freq) in enumerate(zip(self.words, self.freqs)):
+            prev_char = word[0]
+            for char in word[1:]:
+                pair = prev_char << shift | char
+                stats[pair] += freq
+                add_index(indices, pair, i)
+                prev_char = char
+
+        return stats, indices
+
+    def replace_pair(self, pair, indices):
+        """Replace all occurrences of a symbol pair with its merged symbol, in place"""
+        first, second = pair >> self.shift, pair & self.mask
+        new_char = self.intern(self.symbols[first] + self.symbols[second])
+        changes = []
+
+        # an id may be repeated, or be of a word that no longer contains the pair
+        for j in dict.fromkeys(indices.get(pair, ())):
+            word = self.words[j]
+            old_word = word[:]
+
+            # merge left to right, k is the write position
+            i = k = 0
+            n = len(word)
+            while i < n:
+                if i < n-1 and word[i] == first and word[i+1] == second:
+                    word[k] = new_char
+                    i += 2
+                else:
+                    word[k] = word[i]
+                    i += 1
+                k += 1
+            if k == n:
+                continue
+            del word[k:]
+
+            changes.append((j, word, old_word, self.freqs[j]))
+
+        return changes
+
+    def update_pair_statistics(self, pair, changed, stats, indices, queue=None):
+        """Minimally update the indices and frequency of symbol pairs, same as update_pair_statistics"""
+        touched = set()
+        stats[pair] = 0
+        indices[pair] = array('i')
+        add_index = self.add_index
+        shift = self.shift
+        first, second = pair >> shift, pair & self.mask
+        new_char = self.symbol_ids[self.symbols[first] + self.symbols[second]]
+
+        for j, word, old_word, freq in changed:
+
+            # find all instances of pair, and update frequency/indices around it
+            i = 0
+            n = len(old_word)
+            while i < n-1:
+                if old_word[i] != first or old_word[i+1] != second:
+                    i += 1
+                    continue
+                # assuming a symbol sequence "A B C", if "B C" is merged, reduce the frequency of "A B"
+                if i:
+                    prev = old_word[i-1] << shift | first
+                    stats[prev] -= freq
+                    touched.add(prev)
+                # skip "C B" in "A B C B C", already reduced by the previous code block
+                if i < n-2:
+                    if old_word[i+2] != first or i >= n-3 or old_word[i+3] != second:
+                        nex = second << shift | old_word[i+2]
+                        stats[nex] -= freq
+                        touched.add(nex)
+                i += 2
+
+            # find new symbol, and increase frequency of its neighbouring pairs
+            n = len(word)
+            for i in range(n):
+                if word[i] != new_char:
+                    continue
+                if i:
+                    prev = word[i-1] << shift | new_char
+                    stats[prev] += freq
+                    add_index(indices, prev, j)
+                    touched.add(prev)
+                # skip "BC BC", already incremented by the previous code block
+                if i < n-1 and word[i+1] != new_char:
+                    nex = new_char << shift | word[i+1]
+                    stats[nex] += freq
+                    add_index(indices, nex, j)
+                    touched.add(nex)
+
+        if queue is not None:
+            queue.update(touched)
+
+
+class _QueueEntry(object):
+    """Heap entry ordered by frequency then pair, highest first"""
+
+    __slots__ = ('freq', 'key', 'pair')
+
+    def __init__(self, freq, key, pair):
+        self.freq = freq
+        self.key = key
+        self.pair = pair
+
+    def __lt__(self, other):
+        # heapq is a min-heap, so invert the order
+        if self.freq != other.freq:
+            return self.freq > other.freq
+        return self.key > other.key
+
+
+class PairQueue(object):
+    """Indexed max-priority queue over symbol pairs of stats, with lazy deletion
+
+    The frequency of a pair is looked up in stats when it is popped,
+    so an entry is only valid while its frequency is still the current one.
+    Outdated entries are dropped when they reach the top of the heap.
+    key maps a pair to the value used to break frequency ties (default: the pair itself).
+    """
+
+    def __init__(self, stats, key=None):
+        self.stats = stats
+        self.key = key if key else lambda pair: pair
+        self.heap = self._build()
+        # number of rebuilds after too many outdated entries
+        self.rebuilds = 0
+
+    def _build(self):
+        key = self.key
+        heap = [_QueueEntry(freq, key(pair), pair) for pair, freq in self.stats.items()]
+        heapq.heapify(heap)
+        return heap
+
+    def rebuild(self):
+        """Rebuild heap from stats, dropping all outdated entries"""
+        self.heap = self._build()
+        self.rebuilds += 1
+
+    def __len__(self):
+        return len(self.heap)
+
+    def update(self, pairs):
+        """Push the current frequency of each changed pair"""
+        key = self.key
+        for pair in pairs:
+            heapq.heappush(self.heap, _QueueEntry(self.stats[pair], key(pair), pair))
+
+        # too many outdated entries, rebuild from stats
+        if len(self.heap) > 2 * len(self.stats) + 1000:
+            self.rebuild()
+
+    def pop(self):
+        """Remove and return the most frequent pair (ranked by freq then alphabeta), or None if empty"""
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            # skip outdated entry
+            if self.stats.get(entry.pair) == entry.freq:
+                return entry.pair
+        return None
+
+
+def _shard_worker(conn, vocab, compact):
+    """Own a range of the vocabulary: compute its pair statistics, then apply merges and send back the changes of statistics"""
+    if compact:
+        vocab = CompactVocabulary.from_state(vocab)
+        stats, indices = vocab.get_pair_statistics()
+    else:
+        stats, indices = get_pair_statistics(vocab)
+    conn.send(dict(stats))
+    del stats
+
+    while True:
+        command, pair = conn.recv()
+        if command == 'merge':
+            # update_pair_statistics on an empty dict gives the change of frequency of each pair
+            delta = defaultdict(int)
+            if compact:
+                changes = vocab.replace_pair(pair, indices)
+                vocab.update_pair_statistics(pair, changes, delta, indices)
+            else:
+                changes = replace_pair(pair, vocab, indices)
+                update_pair_statistics(pair, changes, delta, indices)
+            conn.send((dict((item, freq) for item, freq in delta.items() if freq), len(changes)))
+        else:
+            if compact:
+                conn.send((vocab.get_state(), indices))
             else:
-                big_stats[item] = freq
+                conn.send((vocab, dict((item, dict(index)) for item, index in indices.items())))
+            break
+
+    conn.close()
+
 
+class ShardedVocabulary(object):
+    """Vocabulary split by index range over worker processes
 
-def main(infile, outfile, num_symbols, min_frequency=2, verbose=False, is_dict=False):
+    Each worker computes the pair statistics and index of its range, and applies merges to it.
+    The statistics of all ranges are summed in stats, so merges are chosen as with the whole vocabulary.
+    vocab is sorted vocabulary, or CompactVocabulary whose symbols are interned in the same order by all processes.
+    """
+
+    def __init__(self, vocab, num_workers, compact=False):
+        self.compact = compact
+        self.offsets = []
+        self.workers = []
+        self.conns = []
+
+        size = len(vocab.words) if compact else len(vocab)
+        for k in range(num_workers):
+            start, end = size * k // num_workers, size * (k+1) // num_workers
+            if compact:
+                shard = {'symbols': vocab.symbols, 'words': vocab.words[start:end], 'freqs': vocab.freqs[start:end]}
+            else:
+                shard = vocab[start:end]
+            conn, child_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_shard_worker, args=(child_conn, shard, compact))
+            worker.daemon = True
+            worker.start()
+            child_conn.close()
+            self.offsets.append(start)
+            self.workers.append(worker)
+            self.conns.append(conn)
+
+        # sum partial statistics
+        self.stats = defaultdict(int)
+        for conn in self.conns:
+            for pair, freq in conn.recv().items():
+                self.stats[pair] += freq
+
+    def merge(self, pair):
+        """Apply merge in all ranges, return change of frequency of each pair and number of words changed"""
+        for conn in self.conns:
+            conn.send(('merge', pair))
+
+        delta = defaultdict(int)
+        num_changed = 0
+        for conn in self.conns:
+            shard_delta, shard_changed = conn.recv()
+            for item, freq in shard_delta.items():
+                delta[item] += freq
+            num_changed += shard_changed
+        return delta, num_changed
+
+    def collect(self):
+        """Stop workers, return merged vocabulary (list, or words and freqs of CompactVocabulary) and pair index"""
+        for conn in self.conns:
+            conn.send(('collect', None))
+
+        words = []
+        freqs = []
+        indices = {} if self.compact else defaultdict(lambda: defaultdict(int))
+        for offset, conn, worker in zip(self.offsets, self.conns, self.workers):
+            shard, shard_indices = conn.recv()
+            if self.compact:
+                words.extend(shard['words'])
+                freqs.extend(shard['freqs'])
+            else:
+                words.extend(shard)
+            # index of word is global again
+            for pair, index in shard_indices.items():
+                if self.compact:
+                    index = array('i', [j + offset for j in index])
+                    if pair in indices:
+                        indices[pair].extend(index)
+                    else:
+                        indices[pair] = index
+                else:
+                    indices[pair].update((j + offset, freq) for j, freq in index.items())
+            conn.close()
+            worker.join()
+
+        return (words, freqs) if self.compact else words, indices
+
+
+class LearnProfiler(object):
+    """Cumulative time and number of calls of each phase of main, and merge counters
+
+    a report is written to stream every `every` merges and at the end,
+    as a readable line, or as a JSON object per line if json_lines.
+    main only measures phases when given a profiler, so there is no cost otherwise.
+    """
+
+    def __init__(self, stream, every=1000, json_lines=False):
+        self.stream = stream
+        self.every = every
+        self.json_lines = json_lines
+        self.start = time.perf_counter()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        # words changed by merges since last report
+        self.merges = 0
+        self.words_changed = 0
+        self.max_words_changed = 0
+
+    def add(self, phase, start):
+        """Add time since start (from time.perf_counter) to phase"""
+        self.seconds[phase] += time.perf_counter() - start
+        self.calls[phase] += 1
+
+    def merged(self, num_changed):
+        """Count a merge which changed num_changed words"""
+        self.merges += 1
+        self.words_changed += num_changed
+        self.max_words_changed = max(self.max_words_changed, num_changed)
+
+    def report(self, num_merges, stats, queue, final=False):
+        """Write counters after num_merges merges, and reset the per-interval ones"""
+        record = {'merges': num_merges,
+                  'final': final,
+                  'elapsed': time.perf_counter() - self.start,
+                  'stats_size': len(stats),
+                  'queue_size': len(queue) if queue is not None else 0,
+                  'queue_rebuilds': queue.rebuilds if queue is not None else 0,
+                  'words_changed_mean': self.words_changed / self.merges if self.merges else 0,
+                  'words_changed_max': self.max_words_changed,
+                  'phases': dict((phase, {'seconds': self.seconds[phase], 'calls': self.calls[phase]})
+                                 for phase in sorted(self.seconds))}
+
+        if self.json_lines:
+            self.stream.write(json.dumps(record) + '\n')
+        else:
+            self.stream.write('[profile] merges {0} elapsed {1:.1f}s stats {2} queue {3} rebuilds {4} words/merge {5:.1f} (max {6}) | {7}\n'.format(
+                num_merges, record['elapsed'], record['stats_size'], record['queue_size'], record['queue_rebuilds'],
+                record['words_changed_mean'], record['words_changed_max'],
+                ' '.join('{0} {1:.2f}s/{2}'.format(phase, value['seconds'], value['calls']) for phase, value in record['phases'].items())))
+        self.stream.flush()
+
+        self.merges = 0
+        self.words_changed = 0
+        self.max_words_changed = 0
+
+
+# first bytes of a checkpoint written by save_checkpoint
+CHECKPOINT_MAGIC = b'BPECKPT1\n'
+
+
+def save_checkpoint(path, compact, vocab, stats, indices, merges):
+    """Save learning state after len(merges) merges, vocab is sorted vocabulary or CompactVocabulary"""
+    state = {'compact': compact,
+             'vocab': vocab.get_state() if compact else vocab,
+             'stats': dict(stats),
+             'indices': indices if compact else dict((pair, dict(index)) for pair, index in indices.items()),
+             'merges': merges}
+
+    # never leave a partial checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(CHECKPOINT_MAGIC)
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def is_checkpoint(path):
+    """Return True if path is a file written by save_checkpoint (only its header is read)"""
+    with open(path, 'rb') as f:
+        return f.read(len(CHECKPOINT_MAGIC)) == CHECKPOINT_MAGIC
+
+
+def load_checkpoint(path):
+    """Return (compact, vocab, stats, indices, merges) saved by save_checkpoint, or None if path is not a checkpoint"""
+    with open(path, 'rb') as f:
+        if f.read(len(CHECKPOINT_MAGIC)) != CHECKPOINT_MAGIC:
+            return None
+        state = pickle.load(f)
+
+    compact = state['compact']
+    vocab = CompactVocabulary.from_state(state['vocab']) if compact else state['vocab']
+    stats = defaultdict(int, state['stats'])
+    if compact:
+        indices = state['indices']
+    else:
+        indices = defaultdict(lambda: defaultdict(int))
+        for pair, index in state['indices'].items():
+            indices[pair] = defaultdict(int, index)
+
+    return compact, vocab, stats, indices, state['merges']
+
+
+def read_merges(codes):
+    """Read merge operations (tuples of symbols) from text codes file"""
+    merges = []
+    with open(codes, encoding='UTF-8') as f:
+        for line in f:
+            if line.startswith('# version'):
+                continue
+            merges.append(tuple(line.split()))
+    return merges
+
+
+def main(infile, outfile, num_symbols, min_frequency=2, verbose=False, is_dict=False, compact=False, num_workers=1,
+         checkpoint=None, checkpoint_every=1000, resume=None, parallel_min_words=1000, profiler=None):
     """Learn num_symbols BPE operations from vocabulary, and write to outfile.
+
+    compact uses CompactVocabulary (integer symbol ids) instead of tuples of strings.
+    num_workers is the number of processes used to count the vocabulary of infile, and, when learning from scratch,
+    to compute pair statistics and apply merges (see ShardedVocabulary) until a merge changes fewer than parallel_min_words words.
+    checkpoint is a path where the state is saved every checkpoint_every merges and at the end.
+    resume is a checkpoint (infile and compact are then ignored) or a codes file, whose merges are replayed
+    on the vocabulary of infile; learning continues until num_symbols merges in total.
+    a checkpoint holds the state after all its merges, so it cannot be resumed with fewer than these (ValueError).
+    profiler is a LearnProfiler recording the time spent in each phase.
     """
 
+    state = load_checkpoint(resume) if resume else None
+    sharded = None
+
+    if state is not None and num_symbols < len(state[4]):
+        raise ValueError('checkpoint {0} has {1} merges, cannot resume it with {2} symbols'.format(resume, len(state[4]), num_symbols))
+
     # version 0.2 changes the handling of the end-of-word token ('</w>')
     # version numbering allows backward compatibility
     outfile.write('# version 0.2.1\n')
 
-    vocab = get_vocabulary(infile, is_dict)
-    
-    # join </w> with last character of word 
-    vocab = dict([(tuple(x[:-1])+(x[-1]+'</w>',) ,y) for (x,y) in vocab.items()])
-    sorted_vocab = sorted(vocab.items(), key=lambda x: x[1], reverse=True)
+    if profiler is not None:
+        start = time.perf_counter()
+
+    if state is not None:
+        compact, vocab, stats, indices, merges = state
+        if profiler is not None:
+            profiler.add('load_checkpoint', start)
+    else:
+        vocab = get_vocabulary(infile, is_dict, num_workers)
+        if profiler is not None:
+            profiler.add('get_vocabulary', start)
+            start = time.perf_counter()
+
+        # join </w> with last character of word 
+        vocab = dict([(tuple(x[:-1])+(x[-1]+'</w>',) ,y) for (x,y) in vocab.items()])
+        vocab = sorted(vocab.items(), key=lambda x: x[1], reverse=True)
+
+        if compact:
+            vocab = CompactVocabulary(vocab)
+
+        if num_workers > 1 and not resume:
+            sharded = ShardedVocabulary(vocab, num_workers, compact)
+            stats, indices = sharded.stats, None
+        elif compact:
+            stats, indices = vocab.get_pair_statistics()
+        else:
+            stats, indices = get_pair_statistics(vocab)
+
+        if profiler is not None:
+            profiler.add('get_pair_statistics', start)
+
+        merges = []
+
+    def apply_merge(pair, queue=None):
+        """Merge pair in vocabulary and statistics, return number of words changed"""
+        nonlocal sharded, vocab, indices
+        if profiler is not None:
+            start = time.perf_counter()
+
+        if sharded is not None:
+            if compact:
+                vocab.intern(''.join(vocab.pair_symbols(pair)))
+            delta, num_changed = sharded.merge(pair)
+            for item, freq in delta.items():
+                stats[item] += freq
+            if queue is not None:
+                queue.update(delta)
+            if profiler is not None:
+                profiler.add('shard_merge', start)
+
+            # few words left to change in each merge, continue in this process
+            if num_changed < parallel_min_words:
+                if profiler is not None:
+                    start = time.perf_counter()
+                words, indices = sharded.collect()
+                if compact:
+                    vocab.words, vocab.freqs = words
+                else:
+                    vocab = words
+                sharded = None
+                if profiler is not None:
+                    profiler.add('shard_collect', start)
+        else:
+            if compact:
+                changes = vocab.replace_pair(pair, indices)
+            else:
+                changes = replace_pair(pair, vocab, indices)
+            if profiler is not None:
+                profiler.add('replace_pair', start)
+                start = time.perf_counter()
 
-    stats, indices = get_pair_statistics(sorted_vocab)
-    big_stats = copy.deepcopy(stats)
-    
-    # threshold is inspired by Zipfian assumption, but should only affect speed
-    threshold = max(stats.values()) / 10
-    for i in range(num_symbols):
-        if stats:
-            # ranked by freq then alphabeta
-            most_frequent = max(stats, key=lambda x: (stats[x], x))
-
-        # we probably missed the best pair because of pruning; go back to full statistics
-        if not stats or (i and stats[most_frequent] < threshold):
-            prune_stats(stats, big_stats, threshold)
-            stats = copy.deepcopy(big_stats)
-            most_frequent = max(stats, key=lambda x: (stats[x], x))
-            # threshold is inspired by Zipfian assumption, but should only affect speed
-            threshold = stats[most_frequent] * i/(i+10000.0)
-            prune_stats(stats, big_stats, threshold)
-
-        if stats[most_frequent] < min_frequency:
+            if compact:
+                vocab.update_pair_statistics(pair, changes, stats, indices, queue)
+            else:
+                update_pair_statistics(pair, changes, stats, indices, queue)
+            if profiler is not None:
+                profiler.add('update_pair_statistics', start)
+            num_changed = len(changes)
+
+        stats[pair] = 0
+        return num_changed
+
+    # replay merges of codes file, without searching the best pair
+    if resume and state is None:
+        merges = read_merges(resume)[:num_symbols]
+        for symbols in merges:
+            if compact:
+                apply_merge(vocab.intern(symbols[0]) << vocab.shift | vocab.intern(symbols[1]))
+            else:
+                apply_merge(symbols)
+        if profiler is not None:
+            profiler.report(len(merges), stats, None)
+
+    # merges already learned
+    for symbols in merges:
+        outfile.write('{0} {1}\n'.format(*symbols))
+
+    if compact:
+        # ties broken by symbol strings, not by ids
+        queue = PairQueue(stats, vocab.pair_symbols)
+    else:
+        # pairs ranked by freq then alphabeta
+        queue = PairQueue(stats)
+
+    for i in range(len(merges), num_symbols):
+        if profiler is not None:
+            start = time.perf_counter()
+
+        most_frequent = queue.pop()
+
+        if profiler is not None:
+            profiler.add('select', start)
+
+        if most_frequent is None or stats[most_frequent] < min_frequency:
             sys.stderr.write('no pair has frequency >= {0}. Stopping\n'.format(min_frequency))
             break
 
+        symbols = vocab.pair_symbols(most_frequent) if compact else most_frequent
+
         if verbose:
-            sys.stderr.write('pair {0}: {1} {2} -> {1}{2} (frequency {3})\n'.format(i, most_frequent[0], most_frequent[1], stats[most_frequent]))
+            sys.stderr.write('pair {0}: {1} {2} -> {1}{2} (frequency {3})\n'.format(i, symbols[0], symbols[1], stats[most_frequent]))
         
-        outfile.write('{0} {1}\n'.format(*most_frequent))
-        changes = replace_pair(most_frequent, sorted_vocab, indices)
-        update_pair_statistics(most_frequent, changes, stats, indices)
-        stats[most_frequent] = 0
+        outfile.write('{0} {1}\n'.format(*symbols))
+        merges.append(symbols)
+        num_changed = apply_merge(most_frequent, queue)
+
+        # no checkpoint while the vocabulary is held by workers
+        if checkpoint and not (i+1) % checkpoint_every and sharded is None:
+            if profiler is not None:
+                start = time.perf_counter()
+            outfile.flush()
+            save_checkpoint(checkpoint, compact, vocab, stats, indices, merges)
+            if profiler is not None:
+                profiler.add('checkpoint', start)
+
+        if profiler is not None:
+            profiler.merged(num_changed)
+            # the last merges are reported once, by the final report
+            if not (i+1) % profiler.every and i+1 < num_symbols:
+                profiler.report(i+1, stats, queue)
+
+    if sharded is not None:
+        words, indices = sharded.collect()
+        if compact:
+            vocab.words, vocab.freqs = words
+        else:
+            vocab = words
+
+    if checkpoint:
+        save_checkpoint(checkpoint, compact, vocab, stats, indices, merges)
 
-        # prune each 100 iters
-        if not i % 100:
-            prune_stats(stats, big_stats, threshold)
+    if profiler is not None:
+        profiler.report(len(merges), stats, queue, final=True)
 
 
 if __name__ == '__main__':
@@ -270,4 +950,18 @@ if __name__ == '__main__':
     parser = create_parser()
     args = parser.parse_args()
 
-    main(args.input, args.output, args.symbols, args.min_frequency, args.verbose, is_dict=args.dict_input)
+    if args.input is None and (args.resume is None or not is_checkpoint(args.resume)):
+        parser.error('--input is required unless resuming from a checkpoint')
+
+    if args.profile_file:
+        profiler = LearnProfiler(args.profile_file, args.profile_every, json_lines=True)
+    elif args.profile:
+        profiler = LearnProfiler(sys.stderr, args.profile_every)
+    else:
+        profiler = None
+
+    try:
+        main(args.input, args.output, args.symbols, args.min_frequency, args.verbose, is_dict=args.dict_input, compact=args.compact, num_workers=args.num_workers,
+             checkpoint=args.checkpoint, checkpoint_every=args.checkpoint_every, resume=args.resume, profiler=profiler)
+    except ValueError as e:
+        parser.error(str(e))
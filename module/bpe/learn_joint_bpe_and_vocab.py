@@ -11,9 +11,7 @@ Proceedings of the 54th Annual Meeting of the Association for Computational Ling
 # python3 only
 
 import sys
-import os
 import argparse
-import tempfile
 from collections import Counter
 
 # local module
@@ -55,6 +53,10 @@ def create_parser():
         '--min-frequency', type=int, default=2, metavar='FREQ',
         help='Stop if no symbol pair has frequency >= FREQ (default: %(default)s))')
         
+    parser.add_argument(
+        '--num-workers', type=int, default=1, metavar='INT',
+        help="Count the vocabulary of each input in this many processes (default: %(default)s))")
+
     parser.add_argument(
         '--verbose', '-v', action="store_true",
         help="verbose mode.")
@@ -62,6 +64,18 @@ def create_parser():
     return parser
 
 
+def segment_vocabulary(bpe, vocab):
+    """Return vocabulary of a text after applying BPE, given the word counts of the text
+
+    each distinct word is segmented once, and its subwords are counted as often as the word
+    """
+    segmented_vocab = Counter()
+    for word, freq in vocab.items():
+        for subword in bpe.segment_tokens([word]):
+            segmented_vocab[subword] += freq
+    return segmented_vocab
+
+
 if __name__ == '__main__':
 
     parser = create_parser()
@@ -72,43 +86,28 @@ if __name__ == '__main__':
         sys.stderr.write('Error: number of input files and vocabulary files must match\n')
         sys.exit(1)
 
-    # get combined vocabulary of all input texts
+    # get vocabulary of each input text, and combined vocabulary
+    vocabs = [learn_bpe.get_vocabulary(f, num_workers=args.num_workers) for f in args.input]
     full_vocab = Counter()
-    for f in args.input:
-        full_vocab += learn_bpe.get_vocabulary(f)
-        f.seek(0)
+    for vocab in vocabs:
+        full_vocab += vocab
 
     vocab_list = ['{0} {1}'.format(key, freq) for (key, freq) in full_vocab.items()]
 
     # learn BPE on combined vocabulary
     learn_bpe.main(vocab_list, args.output, args.symbols, args.min_frequency, args.verbose, is_dict=True)
+    args.output.close()
 
-    with open(args.output.name, 'r', encoding='UTF-8') as codes:
-        bpe = apply_bpe.BPE(codes, separator=args.separator)
-
-    # apply BPE to each training corpus and get vocabulary
-    for train_file, vocab_file in zip(args.input, args.vocab):
-
-        # temp file to save segmented data
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        tmp.close()
-
-        tmpout = open(tmp.name, 'w', encoding='UTF-8')
-
-        train_file.seek(0)
-        for line in train_file:
-            tmpout.write(bpe.segment(line).strip())
-            tmpout.write('\n')
+    if args.vocab:
+        with open(args.output.name, 'r', encoding='UTF-8') as codes:
+            bpe = apply_bpe.BPE(codes, separator=args.separator)
 
-        tmpout.close()
-        tmpin = open(tmp.name, 'r', encoding='UTF-8')
+        # vocabulary of each training corpus after applying BPE, derived from its word counts
+        for vocab, vocab_file in zip(vocabs, args.vocab):
 
-        # get vocab from segmented data
-        vocab = learn_bpe.get_vocabulary(tmpin)
-        tmpin.close()
-        os.remove(tmp.name)
+            segmented_vocab = segment_vocabulary(bpe, vocab)
 
-        # vocab freq descending
-        for key, freq in sorted(vocab.items(), key=lambda x: x[1], reverse=True):
-            vocab_file.write("{0} {1}\n".format(key, freq))
-        vocab_file.close()
+            # vocab freq descending
+            for key, freq in sorted(segmented_vocab.items(), key=lambda x: x[1], reverse=True):
+                vocab_file.write("{0} {1}\n".format(key, freq))
+            vocab_file.close()
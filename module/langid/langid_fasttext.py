@@ -1,7 +1,14 @@
 # created by yuhan
 
+import os
+import json
+import struct
 import fastText
 import argparse
+import threading
+import multiprocessing
+from collections import deque
+from itertools import islice
 
 
 def create_parser():
@@ -26,33 +33,166 @@ def create_parser():
     parser.add_argument('--kmost', '-k', help='most possible k lang', 
                         type=int, default=1)
 
+    parser.add_argument('--chunk', '-c', help='number of lines predicted at once', 
+                        type=int, default=100000)
+
+    parser.add_argument('--workers', '-w', help='number of processes, each holding the model', 
+                        type=int, default=1)
+
+    parser.add_argument('--format', '-f', help='output format: labels only, labels with proba as text or tsv, or binary', 
+                        type=str, default='label', choices=['label', 'text', 'tsv', 'binary'])
+
     return parser
 
 
+# loaded models by path, shared by all calls of this process
+_models = {}
+_models_lock = threading.Lock()
+
+
+# load fasttext model once per path
+def load_model(model_path):
+    
+    key = os.path.realpath(model_path)
+    with _models_lock:
+        model = _models.get(key)
+        if model is None:
+            model = fastText.load_model(model_path)
+            _models[key] = model
+    
+    return model
+
+
+# release model of path, or all models
+def unload_model(model_path=None):
+    
+    with _models_lock:
+        if model_path is None:
+            _models.clear()
+        else:
+            _models.pop(os.path.realpath(model_path), None)
+
+
 def get_lang(docs, model_path, kmost=1):
 
-    lang_classifier = fastText.load_model(model_path)
+    lang_classifier = load_model(model_path)
 
     return lang_classifier.predict(docs, kmost)
 
 
+# model path and kmost of each worker process
+_worker_args = None
+
+
+def _init_worker(model_path, kmost):
+
+    global _worker_args
+    _worker_args = (model_path, kmost)
+    load_model(model_path)
+
+
+def _predict_chunk(docs):
+
+    labels, probas = get_lang(docs, *_worker_args)
+    return [list(l) for l in labels], [[float(p) for p in ps] for ps in probas]
+
+
+def predict_stream(docs, model_path, kmost=1, chunk_size=100000, num_workers=1):
+
+    # yield labels and probas of each chunk of lines, in input order
+    docs = iter(docs)
+    chunks = iter(lambda: list(islice(docs, chunk_size)), [])
+
+    if num_workers <= 1:
+        for chunk in chunks:
+            yield get_lang(chunk, model_path, kmost)
+        return
+
+    # at most two chunks per worker in flight, to bound memory
+    pending = deque()
+    with multiprocessing.Pool(num_workers, _init_worker, (model_path, kmost)) as pool:
+        for chunk in chunks:
+            pending.append(pool.apply_async(_predict_chunk, (chunk,)))
+            if len(pending) >= 2 * num_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+# binary output: magic, header length and json header, then fixed size records
+BINARY_MAGIC = b'LANGID1\n'
+
+
+class BinaryWriter(object):
+
+    # each line is kmost pairs of label index (uint16) and proba (float32),
+    # missing labels are written with index 65535 and proba 0
+    def __init__(self, f, labels, kmost):
+        self.f = f
+        self.index = dict((label, idx) for idx, label in enumerate(labels))
+        self.kmost = kmost
+        self.record = struct.Struct('<' + 'Hf' * kmost)
+        header = json.dumps({'labels': list(labels), 'kmost': kmost}).encode('UTF-8')
+        f.write(BINARY_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+
+    def write(self, labels, probas):
+        values = []
+        for k in range(self.kmost):
+            if k < len(labels):
+                values.extend((self.index[labels[k]], probas[k]))
+            else:
+                values.extend((65535, 0.0))
+        self.f.write(self.record.pack(*values))
+
+
+def read_binary(path):
+
+    # yield list of (label, proba) of each line of a binary output
+    with open(path, 'rb') as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError('{0} is not a binary langid output'.format(path))
+        header_size, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_size).decode('UTF-8'))
+        labels = header['labels']
+        record = struct.Struct('<' + 'Hf' * header['kmost'])
+        for data in iter(lambda: f.read(record.size), b''):
+            values = record.unpack(data)
+            yield [(labels[values[k]], values[k+1]) for k in range(0, len(values), 2) if values[k] != 65535]
+
+
+def format_line(labels, probas, output_format):
+
+    if output_format == 'label':
+        return ' '.join(labels)
+    if output_format == 'text':
+        return ' '.join('{0} {1:.6f}'.format(l, p) for l, p in zip(labels, probas))
+    # tsv
+    return '\t'.join('{0}\t{1:.6f}'.format(l, p) for l, p in zip(labels, probas))
+
+
 if __name__ == '__main__':
 
     parser = create_parser()
     args = parser.parse_args()
 
-    # read input
-    docs = []
-    with open(args.input, encoding=args.encoding) as f:
-        for line in f:
-            docs.append(line.strip())
+    # lines are read, predicted and written chunk by chunk
+    with open(args.input, encoding=args.encoding) as fin:
+        docs = (line.strip() for line in fin)
+        results = predict_stream(docs, args.model, args.kmost, args.chunk, args.workers)
+
+        if args.format == 'binary':
+            with open(args.output, 'wb') as fout:
+                writer = BinaryWriter(fout, load_model(args.model).get_labels(), args.kmost)
+                for labels, probas in results:
+                    for l, p in zip(labels, probas):
+                        writer.write(l, p)
+        else:
+            # output list of possible lang code for each line, with proba
+            with open(args.output, 'w') as fout:
+                for labels, probas in results:
+                    for l, p in zip(labels, probas):
+                        fout.write(format_line(l, p, args.format))
+                        fout.write('\n')
 
-    # get tuple of lang code and its proba
-    doc_lang = get_lang(docs, args.model, args.kmost)
-
-    # write to output
-    with open(args.output, 'w') as f:
-        # output list of possible lang code for each line
-        f.write('\n'.join([' '.join(l) for l in doc_lang[0]]))
-        f.write('\n')
-    
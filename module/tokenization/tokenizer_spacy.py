@@ -1,7 +1,14 @@
 # created by yuhan
 
+import os
+import sys
+import time
+import pickle
 import spacy
 import argparse
+import multiprocessing
+from collections import deque, OrderedDict
+from itertools import islice
 
 
 def create_parser():
@@ -26,16 +33,217 @@ def create_parser():
     parser.add_argument('--batch', '-b', help='process batch size', 
                         type=int, default=10000)
 
-    parser.add_argument('--thread', '-t', help='number of thread', 
-                        type=int, default=2)
+    parser.add_argument('--thread', '-t', help='ignored, spaCy no longer tokenizes with threads, use --workers', 
+                        type=int, default=None)
+
+    parser.add_argument('--workers', '-w', help='number of processes, each tokenizing batches of lines', 
+                        type=int, default=1)
+
+    parser.add_argument('--tokenizer-only', '-k', help='build only the tokenizer of the language, without model', 
+                        action='store_true')
+
+    parser.add_argument('--stream', '-s', help='write lines as they are tokenized, with flat memory', 
+                        action='store_true')
+
+    parser.add_argument('--memo-size', '-m', help='number of distinct lines whose tokenization is kept, 0 to disable', 
+                        type=int, default=1000000)
+
+    parser.add_argument('--memo-file', '-f', help='file keeping the memo across runs of the same model', 
+                        type=str, default=None)
+
+    parser.add_argument('--report', '-r', help='show progress every this many lines', 
+                        type=int, default=50000)
 
     return parser
 
 
-def tok_spacy(lang_model, input_path, encoding='UTF-8', batch_size=10000, num_thread=2):
+class TokenMemo(object):
+    
+    # tokenized lines by stripped line, least recently used are evicted beyond max_size
+    def __init__(self, max_size=1000000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.lines = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, line):
+        value = self.entries.get(line)
+        if value is not None:
+            self.entries.move_to_end(line)
+        return value
+
+    def __setitem__(self, line, value):
+        self.entries[line] = value
+        self.entries.move_to_end(line)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def save(self, path, key):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'key': key, 'entries': list(self.entries.items())}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self, path, key):
+        # entries of another model or spacy version are ignored
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if data.get('key') != key:
+            return False
+        for line, value in data['entries']:
+            self[line] = value
+        return True
+
+
+def memo_key(lang_model, tokenizer_only=False):
+    
+    # tokenization depends on spacy version, and on model version unless blank
+    if tokenizer_only:
+        return 'blank {0} spacy {1}'.format(lang_model.split('_')[0], spacy.__version__)
+    return '{0} {1} spacy {2}'.format(lang_model, spacy.util.get_package_version(lang_model), spacy.__version__)
+
+
+def count_lines(input_path, chunk_size=1<<20):
+    
+    # count newlines in binary, much faster than tokenization
+    num_line = 0
+    with open(input_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            num_line += chunk.count(b'\n')
+    
+    return num_line
 
+
+def show_progress(count, num_doc, start):
+    
+    elapsed = time.time() - start
+    speed = count / elapsed if elapsed > 0 else 0.0
+    print(count, '/', num_doc, 'have been processed', '({0:.0f} lines/sec)'.format(speed), file=sys.stderr)
+
+
+def doc_to_line(doc):
+    
+    return ' '.join([w.text.strip() for w in doc if w.text.strip() != ''])
+
+
+def load_nlp(lang_model, tokenizer_only=False):
+    
+    # blank language has the same tokenizer rules, without vectors or components
+    if tokenizer_only:
+        return spacy.blank(lang_model.split('_')[0])
+    
     # load spacy model and disable useless module
-    nlp = spacy.load(lang_model, disable=['tagger', 'parser', 'ner'])
+    return spacy.load(lang_model, disable=['tagger', 'parser', 'ner'])
+
+
+def tok_docs(nlp, docs, batch_size=10000, tokenizer_only=False):
+    
+    if tokenizer_only:
+        docs_pipe = nlp.tokenizer.pipe(docs, batch_size=batch_size)
+    else:
+        docs_pipe = nlp.pipe(docs, batch_size=batch_size)
+    
+    for doc in docs_pipe:
+        yield doc_to_line(doc)
+
+
+# nlp of each worker process
+_worker_nlp = None
+_worker_tokenizer_only = False
+
+
+def _init_worker(lang_model, tokenizer_only):
+    
+    global _worker_nlp, _worker_tokenizer_only
+    _worker_nlp = load_nlp(lang_model, tokenizer_only)
+    _worker_tokenizer_only = tokenizer_only
+
+
+def _tok_block(docs):
+    
+    return list(tok_docs(_worker_nlp, docs, len(docs), _worker_tokenizer_only))
+
+
+def tok_parallel(lang_model, docs, batch_size=10000, num_workers=2, tokenizer_only=False):
+    
+    # batches of lines are tokenized by workers and yielded in input order,
+    # with at most two batches per worker in flight
+    batches = iter(lambda: list(islice(docs, batch_size)), [])
+    pending = deque()
+    
+    with multiprocessing.Pool(num_workers, _init_worker, (lang_model, tokenizer_only)) as pool:
+        for batch in batches:
+            pending.append(pool.apply_async(_tok_block, (batch,)))
+            if len(pending) >= 2 * num_workers:
+                for line in pending.popleft().get():
+                    yield line
+        while pending:
+            for line in pending.popleft().get():
+                yield line
+
+
+def tok_memo(lang_model, docs, memo, batch_size=10000, num_workers=1, tokenizer_only=False):
+    
+    # each batch of lines is read, and only its distinct lines not in memo are tokenized
+    docs = iter(docs)
+    batches = iter(lambda: list(islice(docs, batch_size)), [])
+    
+    pool = None
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers, _init_worker, (lang_model, tokenizer_only))
+    else:
+        nlp = load_nlp(lang_model, tokenizer_only)
+    
+    try:
+        for batch in batches:
+            # tokenized lines of the batch, taken from memo before it evicts any of them
+            known = {}
+            misses = []
+            for line in batch:
+                if line in known:
+                    continue
+                known[line] = memo.get(line)
+                if known[line] is None:
+                    misses.append(line)
+            
+            if pool is not None:
+                size = max(-(-len(misses) // num_workers), 1)
+                blocks = [misses[k:k+size] for k in range(0, len(misses), size)]
+                misses_tok = [line_tok for block in pool.map(_tok_block, blocks) for line_tok in block]
+            else:
+                misses_tok = tok_docs(nlp, misses, batch_size, tokenizer_only)
+            
+            for line, line_tok in zip(misses, misses_tok):
+                known[line] = line_tok
+                memo[line] = line_tok
+            
+            memo.lines += len(batch)
+            memo.hits += len(batch) - len(misses)
+            for line in batch:
+                yield known[line]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def tokenize(lang_model, docs, batch_size=10000, num_workers=1, tokenizer_only=False, memo=None):
+    
+    if memo is not None:
+        return tok_memo(lang_model, docs, memo, batch_size, num_workers, tokenizer_only)
+    
+    if num_workers > 1:
+        return tok_parallel(lang_model, iter(docs), batch_size, num_workers, tokenizer_only)
+    
+    nlp = load_nlp(lang_model, tokenizer_only)
+    return tok_docs(nlp, docs, batch_size, tokenizer_only)
+
+
+def tok_spacy(lang_model, input_path, encoding='UTF-8', batch_size=10000, report_every=50000, 
+              num_workers=1, tokenizer_only=False, memo=None):
 
     # read input data
     docs = []
@@ -45,19 +253,52 @@ def tok_spacy(lang_model, input_path, encoding='UTF-8', batch_size=10000, num_th
 
     # stats
     docs_tok = []
-    num_doc = len(docs_tok)
+    num_doc = len(docs)
     count = 0
+    start = time.time()
     
-    for doc in nlp.pipe(docs, batch_size=batch_size, n_threads=num_thread):
-        # show progress
-        if count%50000 == 0 or count == num_doc-1:
-            print(count, '/', num_doc, 'have been processed')
-        count += 1
+    for line_tok in tokenize(lang_model, docs, batch_size, num_workers, tokenizer_only, memo):
         # processing
-        docs_tok.append(' '.join([w.text.strip() for w in doc if w.text.strip() != '']))
+        docs_tok.append(line_tok)
+        count += 1
+        # show progress
+        if count%report_every == 0:
+            show_progress(count, num_doc, start)
+
+    # last lines
+    if count%report_every != 0:
+        show_progress(count, num_doc, start)
     
     return docs_tok
 
+
+def tok_spacy_stream(lang_model, input_path, output_path, encoding='UTF-8', batch_size=10000, 
+                     report_every=50000, buffer_size=1<<20, num_workers=1, tokenizer_only=False, memo=None):
+
+    # stats
+    num_doc = count_lines(input_path)
+    count = 0
+    start = time.time()
+
+    # lines are read lazily by nlp.pipe, only a few batches are held in memory
+    with open(input_path, 'r', encoding=encoding) as fin, \
+         open(output_path, 'w', encoding=encoding, buffering=buffer_size) as fout:
+        docs = (line.strip() for line in fin)
+        for line_tok in tokenize(lang_model, docs, batch_size, num_workers, tokenizer_only, memo):
+            # processing
+            fout.write(line_tok)
+            fout.write('\n')
+            count += 1
+            # show progress
+            if count%report_every == 0:
+                show_progress(count, num_doc, start)
+
+    # last lines
+    if count%report_every != 0:
+        show_progress(count, num_doc, start)
+    
+    return count
+
 if __name__ == "__main__":
     
     parser = create_parser()
@@ -71,10 +312,31 @@ if __name__ == "__main__":
     else:
         lang_model = 'en_core_web_lg'
 
-    # tokenize input file
-    docs_tok = tok_spacy(lang_model, args.input, args.encoding, args.batch, args.thread)
+    # duplicate lines are tokenized once
+    memo = None
+    if args.memo_size > 0:
+        memo = TokenMemo(args.memo_size)
+        if args.memo_file and os.path.exists(args.memo_file):
+            if not memo.load(args.memo_file, memo_key(lang_model, args.tokenizer_only)):
+                print('memo file', args.memo_file, 'is for another model, ignored', file=sys.stderr)
+
+    # tokenize input file to output, line by line
+    if args.stream:
+        tok_spacy_stream(lang_model, args.input, args.output, args.encoding, args.batch, args.report, 
+                         num_workers=args.workers, tokenizer_only=args.tokenizer_only, memo=memo)
+    else:
+        # tokenize input file
+        docs_tok = tok_spacy(lang_model, args.input, args.encoding, args.batch, args.report, 
+                             args.workers, args.tokenizer_only, memo)
+
+        # write to output
+        with open(args.output, 'w') as f:
+            f.write('\n'.join(docs_tok))
+            f.write('\n')
 
-    # write to output
-    with open(args.output, 'w') as f:
-        f.write('\n'.join(docs_tok))
-        f.write('\n')
+    if memo is not None:
+        if args.memo_file:
+            memo.save(args.memo_file, memo_key(lang_model, args.tokenizer_only))
+        hit_rate = memo.hits / memo.lines if memo.lines else 0.0
+        print('memo:', memo.hits, '/', memo.lines, 'lines not tokenized again', 
+              '({0:.1%} hit rate),'.format(hit_rate), len(memo), 'lines kept', file=sys.stderr)
@@ -1,10 +1,100 @@
 # created by yuhan
+import os
+import sqlite3
+import hashlib
+import threading
 import fastText
 
 
+# loaded models by path, shared by all calls of this process
+_models = {}
+_models_lock = threading.Lock()
+
+
+# load fasttext model once per path
+def load_model(model_path):
+    
+    key = os.path.realpath(model_path)
+    with _models_lock:
+        model = _models.get(key)
+        if model is None:
+            model = fastText.load_model(model_path)
+            _models[key] = model
+    
+    return model
+
+
+# release model of path, or all models
+def unload_model(model_path=None):
+    
+    with _models_lock:
+        if model_path is None:
+            _models.clear()
+        else:
+            _models.pop(os.path.realpath(model_path), None)
+
+
+# fingerprint of model file, from its size and first MB
+def model_fingerprint(model_path, head_size=1<<20):
+    
+    h = hashlib.sha1()
+    h.update(str(os.path.getsize(model_path)).encode('UTF-8'))
+    with open(model_path, 'rb') as f:
+        h.update(f.read(head_size))
+    
+    return h.hexdigest()
+
+
+# key of line in langid cache, depends on model and kmost
+def lang_cache_key(doc, fingerprint, kmost):
+    
+    return hashlib.sha1('{0} {1}\n{2}'.format(fingerprint, kmost, doc).encode('UTF-8')).digest()
+
+
+# predict with sqlite cache at cache_path, only lines not in cache are predicted
+def get_lang_cached(docs, model_path, kmost, cache_path, batch_size=500):
+    
+    fingerprint = model_fingerprint(model_path)
+    keys = [lang_cache_key(doc, fingerprint, kmost) for doc in docs]
+    
+    conn = sqlite3.connect(cache_path)
+    try:
+        conn.execute('CREATE TABLE IF NOT EXISTS lang (key BLOB PRIMARY KEY, labels TEXT, probas TEXT)')
+        
+        # lookup by batch of keys
+        found = {}
+        distinct = list(set(keys))
+        for i in range(0, len(distinct), batch_size):
+            batch = distinct[i:i+batch_size]
+            query = 'SELECT key, labels, probas FROM lang WHERE key IN ({0})'.format(','.join('?' * len(batch)))
+            for key, labels, probas in conn.execute(query, batch):
+                found[key] = (tuple(labels.split(' ')), [float(p) for p in probas.split(' ')])
+        
+        # predict each missing line once, and write back
+        misses = {}
+        for doc, key in zip(docs, keys):
+            if key not in found and key not in misses:
+                misses[key] = doc
+        if misses:
+            labels, probas = load_model(model_path).predict(list(misses.values()), kmost)
+            rows = []
+            for key, l, p in zip(misses, labels, probas):
+                found[key] = (tuple(l), [float(x) for x in p])
+                rows.append((key, ' '.join(l), ' '.join(repr(float(x)) for x in p)))
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO lang VALUES (?, ?, ?)', rows)
+    finally:
+        conn.close()
+    
+    return [found[key][0] for key in keys], [found[key][1] for key in keys]
+
+
 # get language code by fasttext
-def get_lang(docs, model_path, kmost=1):
+def get_lang(docs, model_path, kmost=1, cache_path=None):
+
+    if cache_path is not None:
+        return get_lang_cached(docs, model_path, kmost, cache_path)
 
-    lang_classifier = fastText.load_model(model_path)
+    lang_classifier = load_model(model_path)
 
     return lang_classifier.predict(docs, kmost)
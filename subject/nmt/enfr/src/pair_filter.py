@@ -1,22 +1,201 @@
 # created by yuhan
+import os
+import re
+import random
+import shutil
+import struct
+import hashlib
+import tempfile
+import multiprocessing
+from itertools import islice
 
+import numpy as np
 
-# remove duplicate pair
-def pair_deduplicate(doc_left, doc_right):
+from src.nlp_algo import get_lang
+
+
+# fixed-width digests of sentences, as array of shape (len(docs), digest_bits/64) of unsigned 64 bits;
+# 64 bits digests are the (siphash) string hash of python, only valid in this process
+def doc_digests(docs, digest_bits=64):
     
-    doc_left_clean = []
-    doc_right_clean = []
+    if digest_bits == 64:
+        return np.fromiter((hash(doc) for doc in docs), dtype=np.int64, count=len(docs)).view(np.uint64).reshape(-1, 1)
+    
+    size = digest_bits // 8
+    data = b''.join(hashlib.blake2b(doc.encode('UTF-8'), digest_size=size).digest() for doc in docs)
+    
+    return np.frombuffer(data, dtype='<u8').reshape(len(docs), digest_bits // 64)
+
+
+# unique rows of digests, index of their first occurrence, and index of each row in unique
+def unique_digests(digests):
+    
+    # stable sort, so first row of each run is the first occurrence
+    order = np.lexsort(digests.T[::-1])
+    ordered = digests[order]
+    
+    start = np.ones(len(digests), dtype=bool)
+    start[1:] = (ordered[1:] != ordered[:-1]).any(axis=1)
+    
+    inverse = np.empty(len(digests), dtype=np.int64)
+    inverse[order] = np.cumsum(start) - 1
+    
+    return ordered[start], order[start], inverse
+
+
+# multiplier of fibonacci hashing, spreads keys over slots
+_GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+
+
+# set of 64 or 128 bits digests in a numpy open addressing table, added by batch
+class DigestSet(object):
+    
+    def __init__(self, digest_bits=64, capacity=1<<16):
+        self.num_word = digest_bits // 64
+        self.size = 0
+        self._alloc(capacity)
+    
+    def _alloc(self, capacity):
+        # capacity is a power of 2, first word 0 marks empty slot
+        self.capacity = capacity
+        self.shift = np.uint64(64 - (capacity.bit_length() - 1))
+        self.table = np.zeros((capacity, self.num_word), dtype=np.uint64)
+    
+    def __len__(self):
+        return self.size
+    
+    def add_batch(self, keys):
+        # add digests (array of shape (n, num_word)), return bool array of those not in set before,
+        # a digest repeated in keys is new at most once
+        keys = np.array(keys, dtype=np.uint64).reshape(-1, self.num_word)
+        keys[keys[:, 0] == 0, 0] = 1
+        
+        # keep load factor under 1/2
+        if 2 * (self.size + len(keys)) > self.capacity:
+            self._grow(2 * (self.size + len(keys)))
+        
+        new, _ = self._insert(keys)
+        self.size += int(new.sum())
+        return new
     
-    # already exist
-    doc_contain = set()
+    def _insert(self, keys):
+        # return which keys are new, and slot of each key
+        new = np.zeros(len(keys), dtype=bool)
+        key_slots = np.empty(len(keys), dtype=np.int64)
+        mask = self.capacity - 1
+        todo = np.arange(len(keys))
+        slots = ((keys[:, 0] * _GOLDEN) >> self.shift).astype(np.int64)
+        
+        # probe all keys at once until each is found or written
+        while len(todo):
+            current = self.table[slots]
+            found = (current == keys[todo]).all(axis=1)
+            empty = current[:, 0] == 0
+            
+            # one key is written per empty slot, the others look at it again
+            candidates = np.flatnonzero(empty)
+            _, first = np.unique(slots[candidates], return_index=True)
+            written = candidates[first]
+            self.table[slots[written]] = keys[todo[written]]
+            new[todo[written]] = True
+            
+            done = found
+            done[written] = True
+            key_slots[todo[done]] = slots[done]
+            slots = np.where(found | empty, slots, (slots + 1) & mask)
+            todo = todo[~done]
+            slots = slots[~done]
+        
+        return new, key_slots
+    
+    def _grow(self, min_capacity):
+        old = self.table[self.table[:, 0] != 0]
+        capacity = self.capacity
+        while capacity < min_capacity:
+            capacity *= 2
+        self._alloc(capacity)
+        self._insert(old)
+
+
+# map of 64 or 128 bits digests to the int64 value given with their first occurrence
+class DigestMap(DigestSet):
+    
+    def _alloc(self, capacity):
+        DigestSet._alloc(self, capacity)
+        self.values = np.zeros(capacity, dtype=np.int64)
     
-    for dl, dr in zip(doc_left, doc_right):
-        if (dl not in doc_contain) and (dr not in doc_contain):
-            doc_left_clean.append(dl)
-            doc_right_clean.append(dr)
+    def add_batch(self, keys, values):
+        # add digests with their values if not in map, return value of each digest,
+        # a digest repeated in keys gets the value of its first occurrence
+        keys = np.array(keys, dtype=np.uint64).reshape(-1, self.num_word)
+        keys[keys[:, 0] == 0, 0] = 1
         
-        doc_contain.add(dl)
-        doc_contain.add(dr)
+        if 2 * (self.size + len(keys)) > self.capacity:
+            self._grow(2 * (self.size + len(keys)))
+        
+        new, slots = self._insert(keys)
+        self.values[slots[new]] = np.asarray(values, dtype=np.int64)[new]
+        self.size += int(new.sum())
+        return self.values[slots]
+    
+    def _grow(self, min_capacity):
+        used = self.table[:, 0] != 0
+        old, old_values = self.table[used], self.values[used]
+        capacity = self.capacity
+        while capacity < min_capacity:
+            capacity *= 2
+        self._alloc(capacity)
+        _, slots = self._insert(old)
+        self.values[slots] = old_values
+
+
+# keep pairs whose sentences all appear for the first time, given digests of chunk of pairs
+def keep_first_pairs(doc_contain, digests_left, digests_right):
+    
+    num_pair = len(digests_left)
+    # sentences in order: left and right of pair 0, then of pair 1...
+    digests = np.empty((2 * num_pair, digests_left.shape[1]), dtype=np.uint64)
+    digests[0::2] = digests_left
+    digests[1::2] = digests_right
+    
+    unique, first, inverse = unique_digests(digests)
+    new = doc_contain.add_batch(unique)
+    
+    # position of first occurrence in chunk, -1 if seen in an earlier chunk
+    first_pos = np.where(new, first, -1)[inverse]
+    pair_start = np.arange(num_pair) * 2
+    
+    return (first_pos[0::2] >= pair_start) & (first_pos[1::2] >= pair_start)
+
+
+# remove duplicate pair, with sentences or only their digests kept in memory;
+# the lists given and returned hold all sentences anyway, so digests save memory
+# only in streaming (DeduplicateStage of FilterPipeline)
+def pair_deduplicate(doc_left, doc_right, digest_bits=None, chunk_size=1000000):
+    
+    doc_left_clean = []
+    doc_right_clean = []
+    
+    if digest_bits:
+        # digests checked chunk by chunk
+        doc_contain = DigestSet(digest_bits)
+        for start in range(0, len(doc_left), chunk_size):
+            chunk_left = doc_left[start:start+chunk_size]
+            chunk_right = doc_right[start:start+chunk_size]
+            keep = keep_first_pairs(doc_contain, doc_digests(chunk_left, digest_bits), doc_digests(chunk_right, digest_bits))
+            for idx in np.flatnonzero(keep):
+                doc_left_clean.append(chunk_left[idx])
+                doc_right_clean.append(chunk_right[idx])
+    else:
+        # already exist
+        doc_contain = set()
+        for dl, dr in zip(doc_left, doc_right):
+            if (dl not in doc_contain) and (dr not in doc_contain):
+                doc_left_clean.append(dl)
+                doc_right_clean.append(dr)
+            
+            doc_contain.add(dl)
+            doc_contain.add(dr)
         
     print('remove duplicate from langauge pair')
     print('from {0} to {1}'.format(len(doc_left), len(doc_left_clean)))
@@ -24,20 +203,288 @@ def pair_deduplicate(doc_left, doc_right):
     return doc_left_clean, doc_right_clean
 
 
-# remove duplicate pair
-def pair_oversize(doc_left, doc_right, th_num=80):
+# remove duplicate pair of files larger than memory, with digests spilled to hash-partitioned buckets,
+# same pairs are kept as by pair_deduplicate
+def pair_deduplicate_external(left_path, right_path, left_output, right_output, num_bucket=256, digest_bits=64, 
+                              tmp_dir=None, encoding='UTF-8'):
     
-    doc_left_clean = []
-    doc_right_clean = []
+    record = struct.Struct('<{0}sQ'.format(digest_bits//8))
+    work_dir = tempfile.mkdtemp(prefix='dedup.', dir=tmp_dir)
     
-    for dl, dr in zip(doc_left, doc_right):
+    try:
+        # write digest and pair index of each sentence to its bucket
+        buckets = [open(os.path.join(work_dir, str(b)), 'wb', buffering=1<<16) for b in range(num_bucket)]
+        num_pair = 0
+        for pair in pair_stream(left_path, right_path, encoding):
+            for doc in (pair.left, pair.right):
+                digest = hashlib.blake2b(doc.encode('UTF-8'), digest_size=digest_bits//8).digest()
+                buckets[int.from_bytes(digest[:4], 'little') % num_bucket].write(record.pack(digest, num_pair))
+            num_pair += 1
+        for f in buckets:
+            f.close()
         
-        ll = len(dl.split())
-        lr = len(dr.split())
+        # a pair is kept if both sentences appear there for the first time,
+        # each bucket is loaded alone to mark the others
+        dropped = bytearray((num_pair + 7) // 8)
+        for b in range(num_bucket):
+            path = os.path.join(work_dir, str(b))
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.remove(path)
+            first = {}
+            for digest, idx in record.iter_unpack(data):
+                if first.setdefault(digest, idx) != idx:
+                    dropped[idx >> 3] |= 1 << (idx & 7)
         
-        if (ll < th_num) and (lr < th_num):
-            doc_left_clean.append(dl)
-            doc_right_clean.append(dr)
+        # write pairs not dropped
+        num_clean = 0
+        with open(left_output, 'w', encoding=encoding) as fl, open(right_output, 'w', encoding=encoding) as fr:
+            for idx, pair in enumerate(pair_stream(left_path, right_path, encoding)):
+                if not dropped[idx >> 3] & (1 << (idx & 7)):
+                    fl.write(pair.left + '\n')
+                    fr.write(pair.right + '\n')
+                    num_clean += 1
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    print('remove duplicate from langauge pair')
+    print('from {0} to {1}'.format(num_pair, num_clean))
+    
+    return num_clean
+
+
+# normalize sentence for near duplicate: case, digits, punctuation and whitespace
+_re_punct = re.compile(r'[^\w\s]+')
+_re_digit = re.compile(r'\d')
+_re_space = re.compile(r'\s+')
+
+
+def near_normalize(doc):
+    
+    doc = _re_digit.sub('0', doc.lower())
+    doc = _re_punct.sub(' ', doc)
+    return _re_space.sub(' ', doc).strip()
+
+
+# minhash signatures and lsh bands of sentence pairs
+class MinHashLSH(object):
+    
+    def __init__(self, threshold=0.8, num_perm=128, ngram=5, seed=1):
+        self.threshold = threshold
+        self.ngram = ngram
+        self.num_band, self.num_row = lsh_bands(threshold, num_perm)
+        self.num_perm = self.num_band * self.num_row
+        
+        # multiply-shift hash functions, odd multipliers
+        rng = np.random.RandomState(seed)
+        self.perm_a = rng.randint(1, 1<<62, size=self.num_perm, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+        self.perm_b = rng.randint(0, 1<<62, size=self.num_perm, dtype=np.int64).astype(np.uint64)
+        self.band_mult = rng.randint(1, 1<<62, size=self.num_row, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+        
+        # first doc of each band key seen so far
+        self.band_docs = DigestMap(64)
+        self.num_doc = 0
+        
+        # ids (increasing) and signatures of docs first having a band key, compared to the later docs having it;
+        # only the low 16 bits of each row are kept, equal by chance once in 65536
+        self.num_stored = 0
+        self.stored_ids = np.zeros(1024, dtype=np.int64)
+        self.stored_sigs = np.zeros((1024, self.num_perm), dtype=np.uint16)
+    
+    def shingle_hashes(self, docs):
+        # hashes of character ngrams of all docs, and offset of first ngram of each doc
+        n = self.ngram
+        texts = [doc.ljust(n) for doc in docs]
+        codes = np.frombuffer(''.join(texts).encode('UTF-32-LE'), dtype=np.uint32).astype(np.uint64)
+        
+        # polynomial hash of each ngram starting at each position
+        num_pos = len(codes) - n + 1
+        hashes = np.zeros(num_pos, dtype=np.uint64)
+        for k in range(n):
+            np.multiply(hashes, np.uint64(1000003), out=hashes)
+            np.add(hashes, codes[k:k+num_pos], out=hashes)
+        
+        # only ngrams inside a doc: position in its doc is below its number of ngrams
+        lengths = np.array([len(text) for text in texts], dtype=np.int64)
+        counts = lengths - n + 1
+        starts = np.cumsum(lengths) - lengths
+        doc_ids = np.repeat(np.arange(len(texts)), lengths)[:num_pos]
+        valid = np.arange(num_pos) - starts[doc_ids] < counts[doc_ids]
+        offsets = np.cumsum(counts) - counts
+        
+        return hashes[valid], offsets
+    
+    def signatures(self, docs, perm_block=8, max_ngrams=1<<16):
+        # minimum of each hash function over the ngrams of each doc, shape (len(docs), num_perm);
+        # docs are hashed by groups of about max_ngrams ngrams, in one reused buffer
+        sig = np.empty((len(docs), self.num_perm), dtype=np.uint32)
+        lengths = np.array([max(len(doc), self.ngram) - self.ngram + 1 for doc in docs], dtype=np.int64)
+        ends = np.cumsum(lengths)
+        
+        buf = None
+        start = 0
+        while start < len(docs):
+            # at least one doc per group
+            stop = max(int(np.searchsorted(ends, ends[start] - lengths[start] + max_ngrams, side='right')), start + 1)
+            hashes, offsets = self.shingle_hashes(docs[start:stop])
+            if buf is None or buf.shape[1] < len(hashes):
+                buf = np.empty((perm_block, len(hashes)), dtype=np.uint64)
+            values = buf[:, :len(hashes)]
+            
+            for k in range(0, self.num_perm, perm_block):
+                a = self.perm_a[k:k+perm_block, None]
+                b = self.perm_b[k:k+perm_block, None]
+                block = values[:len(a)]
+                np.multiply(a, hashes[None, :], out=block)
+                np.add(block, b, out=block)
+                np.right_shift(block, np.uint64(32), out=block)
+                sig[start:stop, k:k+len(a)] = np.minimum.reduceat(block, offsets, axis=1).T
+            start = stop
+        
+        return sig
+    
+    def band_keys(self, sig):
+        # one 64 bits key per band of rows, shape (len(sig), num_band)
+        rows = sig[:, :self.num_perm].astype(np.uint64).reshape(len(sig), self.num_band, self.num_row)
+        keys = (rows * self.band_mult).sum(axis=2)
+        return keys ^ (np.arange(self.num_band, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15))
+    
+    def store(self, ids, sigs):
+        # append signatures of docs, capacity doubles
+        end = self.num_stored + len(ids)
+        if end > len(self.stored_ids):
+            capacity = len(self.stored_ids)
+            while capacity < end:
+                capacity *= 2
+            self.stored_ids = np.resize(self.stored_ids, capacity)
+            self.stored_sigs = np.resize(self.stored_sigs, (capacity, self.num_perm))
+        self.stored_ids[self.num_stored:end] = ids
+        self.stored_sigs[self.num_stored:end] = sigs
+        self.num_stored = end
+    
+    def keep_batch(self, docs, chunk_size=1<<15):
+        # keep doc unless an earlier doc sharing one of its bands has estimated jaccard (fraction of equal rows
+        # of signatures) >= threshold; band keys of all docs are remembered, with the first doc having each
+        sig = self.signatures(docs)
+        short = sig.astype(np.uint16)
+        ids = self.num_doc + np.arange(len(docs))
+        self.num_doc += len(docs)
+        
+        keys = self.band_keys(sig).reshape(-1, 1)
+        first = self.band_docs.add_batch(keys, np.repeat(ids, self.num_band)).reshape(len(docs), self.num_band)
+        own = first == ids[:, None]
+        owner = own.any(axis=1)
+        self.store(ids[owner], short[owner])
+        
+        # distinct (doc, earlier doc) candidates, earlier docs all own a key so are stored
+        doc_idx, band_idx = np.nonzero(~own)
+        candidates = np.unique(np.stack([doc_idx, first[doc_idx, band_idx]], axis=1), axis=0)
+        rows = np.searchsorted(self.stored_ids[:self.num_stored], candidates[:, 1])
+        
+        keep = np.ones(len(docs), dtype=bool)
+        min_equal = self.threshold * self.num_perm
+        for start in range(0, len(candidates), chunk_size):
+            docs_chunk = candidates[start:start+chunk_size, 0]
+            equal = np.count_nonzero(self.stored_sigs[rows[start:start+chunk_size]] == short[docs_chunk], axis=1)
+            keep[docs_chunk[equal >= min_equal]] = False
+        
+        return list(keep)
+
+
+# bands and rows per band of lsh: the most rows per band (fewest candidates to check) such that
+# a pair of similarity threshold is a candidate with probability at least recall
+def lsh_bands(threshold, num_perm, recall=0.99):
+    
+    best = (num_perm, 1)
+    for num_row in range(1, num_perm + 1):
+        num_band = num_perm // num_row
+        if 1 - (1 - threshold ** num_row) ** num_band >= recall:
+            best = (num_band, num_row)
+    
+    return best
+
+
+def near_pair_text(dl, dr):
+    
+    return near_normalize(dl) + ' ||| ' + near_normalize(dr)
+
+
+# remove near duplicate pair, similar by minhash of normalized both sides to an earlier pair
+def pair_near_deduplicate(doc_left, doc_right, threshold=0.8, num_perm=128, ngram=5, batch_size=10000):
+    
+    lsh = MinHashLSH(threshold, num_perm, ngram)
+    
+    doc_left_clean = []
+    doc_right_clean = []
+    
+    for start in range(0, len(doc_left), batch_size):
+        batch_left = doc_left[start:start+batch_size]
+        batch_right = doc_right[start:start+batch_size]
+        keep = lsh.keep_batch([near_pair_text(dl, dr) for dl, dr in zip(batch_left, batch_right)])
+        for dl, dr, k in zip(batch_left, batch_right, keep):
+            if k:
+                doc_left_clean.append(dl)
+                doc_right_clean.append(dr)
+    
+    print('remove near duplicate from langauge pair')
+    print('from {0} to {1}'.format(len(doc_left), len(doc_left_clean)))
+    
+    return doc_left_clean, doc_right_clean
+
+
+def _count_tokens(docs):
+    
+    return [len(d.split()) for d in docs]
+
+
+# number of tokens of each sentence, counted by chunks in parallel if large
+def token_counts(docs, num_workers=1, chunk_size=1000000):
+    
+    if num_workers <= 1 or len(docs) <= chunk_size:
+        return np.fromiter((len(d.split()) for d in docs), dtype=np.int64, count=len(docs))
+    
+    chunks = [docs[k:k+chunk_size] for k in range(0, len(docs), chunk_size)]
+    with multiprocessing.Pool(num_workers) as pool:
+        counts = pool.map(_count_tokens, chunks)
+    
+    return np.concatenate([np.array(c, dtype=np.int64) for c in counts])
+
+
+# token counts of both sides, computed once to sweep thresholds on masks
+def length_features(doc_left, doc_right, num_workers=1):
+    
+    return token_counts(doc_left, num_workers), token_counts(doc_right, num_workers)
+
+
+# keep pairs whose both sides have less than th_num tokens
+def oversize_mask(len_left, len_right, th_num=80):
+    
+    return (len_left < th_num) & (len_right < th_num)
+
+
+# keep pairs of similar length ratio, or short pairs of close length
+def mislength_mask(len_left, len_right, ratio=1.8):
+    
+    ratio_ok = (len_left < len_right*ratio) & (len_right < len_left*ratio)
+    short_ok = ((len_left < 8) | (len_right < 8)) & (np.abs(len_left - len_right) < 8)
+    
+    return ratio_ok | short_ok
+
+
+# pairs selected by boolean mask
+def apply_mask(doc_left, doc_right, mask):
+    
+    index = np.flatnonzero(mask)
+    
+    return [doc_left[i] for i in index], [doc_right[i] for i in index]
+
+
+# remove oversize pair, lengths from length_features can be given
+def pair_oversize(doc_left, doc_right, th_num=80, lengths=None):
+    
+    len_left, len_right = lengths if lengths is not None else length_features(doc_left, doc_right)
+    
+    doc_left_clean, doc_right_clean = apply_mask(doc_left, doc_right, oversize_mask(len_left, len_right, th_num))
         
     print('remove oversize pair from langauge pair')
     print('from {0} to {1}'.format(len(doc_left), len(doc_left_clean)))
@@ -45,11 +492,33 @@ def pair_oversize(doc_left, doc_right, th_num=80):
     return doc_left_clean, doc_right_clean
 
 
+# remove mislength pair, lengths from length_features can be given
+def pair_mislength(doc_left, doc_right, ratio=1.8, verbose=False, lengths=None):
+    
+    len_left, len_right = lengths if lengths is not None else length_features(doc_left, doc_right)
+    
+    mask = mislength_mask(len_left, len_right, ratio)
+    doc_left_clean, doc_right_clean = apply_mask(doc_left, doc_right, mask)
+        
+    print('remove mislength from langauge pair')
+    print('from {0} to {1}'.format(len(doc_left), len(doc_left_clean)))
+    
+    if verbose:
+        doc_verbose = np.flatnonzero(~mask)
+        print('removed mislength sentences')
+        for idx in random.sample(list(doc_verbose), min(25, len(doc_verbose))):
+            print(doc_left[idx]+' || '+doc_right[idx])
+    
+    return doc_left_clean, doc_right_clean
+
+
 # remove mislang pair
-def pair_mislang(doc_left, doc_right, lang_left, lang_right, model_path, kmost=2, verbose=False):
+def pair_mislang(doc_left, doc_right, lang_left, lang_right, model_path, kmost=2, verbose=False, cache_path=None):
     
-    res_left = get_lang(doc_left, model_path, kmost)
-    res_right = get_lang(doc_right, model_path, kmost)
+    # both sides in one prediction, from cache file if given
+    res = get_lang(list(doc_left) + list(doc_right), model_path, kmost, cache_path)
+    res_left = res[0][:len(doc_left)]
+    res_right = res[0][len(doc_left):]
     
     doc_left_clean = []
     doc_right_clean = []
@@ -58,8 +527,8 @@ def pair_mislang(doc_left, doc_right, lang_left, lang_right, model_path, kmost=2
     
     for idx in range(len(doc_left)):
         
-        rl = [l.split('__')[-1] for l in res_left[0][idx]]
-        rr = [l.split('__')[-1] for l in res_right[0][idx]]
+        rl = [l.split('__')[-1] for l in res_left[idx]]
+        rr = [l.split('__')[-1] for l in res_right[idx]]
         
         if (lang_left in rl) and (lang_right in rr):
             doc_left_clean.append(doc_left[idx])
@@ -72,7 +541,177 @@ def pair_mislang(doc_left, doc_right, lang_left, lang_right, model_path, kmost=2
     
     if verbose:
         print('removed mislength sentences')
-        for idx in random.sample(range(0,len(doc_verbose)), 25):
+        for idx in random.sample(range(0,len(doc_verbose)), min(25, len(doc_verbose))):
             print(doc_verbose[idx])
     
     return doc_left_clean, doc_right_clean
+
+
+# sentence pair, with token counts computed once for all stages
+class Pair(object):
+    
+    __slots__ = ('left', 'right', '_len_left', '_len_right')
+    
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self._len_left = None
+        self._len_right = None
+    
+    @property
+    def len_left(self):
+        if self._len_left is None:
+            self._len_left = len(self.left.split())
+        return self._len_left
+    
+    @property
+    def len_right(self):
+        if self._len_right is None:
+            self._len_right = len(self.right.split())
+        return self._len_right
+
+
+# read pairs lazily from the two sides of a corpus
+def pair_stream(left_path, right_path, encoding='UTF-8'):
+    
+    with open(left_path, 'r', encoding=encoding) as fl, open(right_path, 'r', encoding=encoding) as fr:
+        for dl, dr in zip(fl, fr):
+            yield Pair(dl.strip(), dr.strip())
+
+
+# stages of pipeline, keep(pair) decides each pair,
+# keep_batch(pairs) decides a list of pairs at once if batched
+class DeduplicateStage(object):
+    
+    name = 'duplicate'
+    batched = True
+    
+    # with digest_bits only digests of passed sentences are kept in memory,
+    # 8 or 16 bytes per slot of a table at most half full
+    def __init__(self, digest_bits=None):
+        self.digest_bits = digest_bits
+        self.doc_contain = DigestSet(digest_bits) if digest_bits else set()
+    
+    def keep_batch(self, pairs):
+        if self.digest_bits:
+            return list(keep_first_pairs(self.doc_contain,
+                                         doc_digests([p.left for p in pairs], self.digest_bits),
+                                         doc_digests([p.right for p in pairs], self.digest_bits)))
+        keep = []
+        for pair in pairs:
+            keep.append((pair.left not in self.doc_contain) and (pair.right not in self.doc_contain))
+            self.doc_contain.add(pair.left)
+            self.doc_contain.add(pair.right)
+        return keep
+
+
+class NearDuplicateStage(object):
+    
+    name = 'near duplicate'
+    batched = True
+    
+    def __init__(self, threshold=0.8, num_perm=128, ngram=5):
+        self.lsh = MinHashLSH(threshold, num_perm, ngram)
+    
+    def keep_batch(self, pairs):
+        return self.lsh.keep_batch([near_pair_text(p.left, p.right) for p in pairs])
+
+
+class OversizeStage(object):
+    
+    name = 'oversize'
+    batched = False
+    
+    def __init__(self, th_num=80):
+        self.th_num = th_num
+    
+    def keep(self, pair):
+        return (pair.len_left < self.th_num) and (pair.len_right < self.th_num)
+
+
+class MislengthStage(object):
+    
+    name = 'mislength'
+    batched = False
+    
+    def __init__(self, ratio=1.8):
+        self.ratio = ratio
+    
+    def keep(self, pair):
+        ll = pair.len_left
+        lr = pair.len_right
+        if (ll < lr*self.ratio) and (lr < ll*self.ratio):
+            return True
+        return (ll < 8 or lr < 8) and (abs(ll-lr) < 8)
+
+
+class MislangStage(object):
+    
+    name = 'mislang'
+    batched = True
+    
+    def __init__(self, lang_left, lang_right, model_path, kmost=2, cache_path=None):
+        self.lang_left = lang_left
+        self.lang_right = lang_right
+        self.model_path = model_path
+        self.kmost = kmost
+        self.cache_path = cache_path
+    
+    def keep_batch(self, pairs):
+        # both sides of batch in one prediction
+        res = get_lang([p.left for p in pairs] + [p.right for p in pairs], self.model_path, self.kmost, self.cache_path)
+        res_left = res[0][:len(pairs)]
+        res_right = res[0][len(pairs):]
+        
+        keep = []
+        for labels_left, labels_right in zip(res_left, res_right):
+            rl = [l.split('__')[-1] for l in labels_left]
+            rr = [l.split('__')[-1] for l in labels_right]
+            keep.append((self.lang_left in rl) and (self.lang_right in rr))
+        return keep
+
+
+# chain of stages applied in a single pass, chunk by chunk
+class FilterPipeline(object):
+    
+    def __init__(self, stages, chunk_size=10000):
+        self.stages = stages
+        self.chunk_size = chunk_size
+        self.num_pair = 0
+        self.dropped = [0] * len(stages)
+    
+    def run(self, pairs):
+        
+        pairs = iter(pairs)
+        for chunk in iter(lambda: list(islice(pairs, self.chunk_size)), []):
+            self.num_pair += len(chunk)
+            
+            for idx, stage in enumerate(self.stages):
+                if stage.batched:
+                    keep = stage.keep_batch(chunk) if chunk else []
+                    survivors = [pair for pair, k in zip(chunk, keep) if k]
+                else:
+                    survivors = [pair for pair in chunk if stage.keep(pair)]
+                self.dropped[idx] += len(chunk) - len(survivors)
+                chunk = survivors
+            
+            for pair in chunk:
+                yield pair
+    
+    def run_files(self, left_path, right_path, left_output, right_output, encoding='UTF-8'):
+        
+        # survivors are written as they pass
+        with open(left_output, 'w', encoding=encoding) as fl, open(right_output, 'w', encoding=encoding) as fr:
+            for pair in self.run(pair_stream(left_path, right_path, encoding)):
+                fl.write(pair.left + '\n')
+                fr.write(pair.right + '\n')
+        
+        self.report()
+    
+    def report(self):
+        
+        num_left = self.num_pair
+        for stage, dropped in zip(self.stages, self.dropped):
+            print('remove {0} from langauge pair'.format(stage.name))
+            print('from {0} to {1}'.format(num_left, num_left - dropped))
+            num_left -= dropped